@@ -0,0 +1,543 @@
+# Нагрузочный тест бота без внешних сервисов: Telegram Bot API, Google Sheets
+# и Tenor подменяются заглушками в том же процессе, обновления идут через
+# вебхук Flask (get_updates) в handle_commands.
+#
+#   python bench.py --chats 50 --users 8 --rate 200 --duration 20
+#   python bench.py --storage sqlite --telegram-limits off --flood-limit off
+#   python bench.py --sheets-latency 0.3 --sheets-error-rate 0.2
+#
+# Отчёт: задержка ответа (p50/p95/p99) и пропускная способность по командам,
+# число вызовов Telegram, Google Sheets и Tenor — всего и по командам
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import requests
+
+COMMANDS = {
+    "/choose": 0.2,
+    "/stats": 0.3,
+    "/agr": 0.15,
+    "/list": 0.15,
+    "/register": 0.1,
+    "/monetka": 0.1,
+}
+
+# Счётчик вызовов внешних API по командам: {("/stats", "sheets", "batch_get"): n}.
+# Команду вызова бот пишет в bot.current_command (load_bot подставляет его
+# сюда); ответ Telegram относится к команде, на сообщение которой отвечает.
+# Вызовы вне обработчиков команд (фоновые записи, рассылки) — «фон»
+BACKGROUND = "фон"
+api_calls = Counter()
+api_calls_lock = threading.Lock()
+current_command = threading.local()
+
+def count_call(service, method, command=None):
+    command = command or getattr(current_command, "name", None) or BACKGROUND
+    with api_calls_lock:
+        api_calls[(command, service, method)] += 1
+
+# Заглушка Telegram Bot API: подставляется в telebot через CUSTOM_REQUEST_SENDER.
+# Задержка и доля ответов 429 настраиваются, ответы на сообщения учитываются
+# для замера времени от вебхука до отправки ответа
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.message_id = 10 ** 9
+        self.on_reply = None  # callback(message_id, sent_at)
+        self.command_of = None  # callback(message_id) -> команда
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        params = params or {}
+        reply_parameters = params.get("reply_parameters")
+        reply_to = json.loads(reply_parameters)["message_id"] if reply_parameters else None
+        count_call("telegram", name, self.command_of(reply_to) if reply_to and self.command_of else None)
+        if self.latency:
+            time.sleep(self.latency)
+        if name != "getMe" and random.random() < self.error_rate:
+            return FakeResponse(429, {
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        if name == "getMe":
+            return FakeResponse(200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+            }})
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        if reply_to and self.on_reply:
+            self.on_reply(reply_to, time.monotonic())
+        return FakeResponse(200, {"ok": True, "result": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "group"},
+            "text": params.get("text", ""),
+            "animation": {
+                "file_id": f"file-{message_id}", "file_unique_id": f"u-{message_id}",
+                "width": 1, "height": 1, "duration": 1,
+            },
+        }})
+
+# Та же заглушка по HTTP для RUNTIME=asyncio: AsyncTeleBot ходит в Bot API
+# через aiohttp, поэтому telebot.asyncio_helper.API_URL направляется сюда
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    telegram = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        params = {key: values[-1] for key, values in parse_qs(body).items()}
+        response = self.telegram("post", urlparse(self.path).path, params=params)
+        data = response.text.encode("utf-8")
+        self.send_response(response.status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # AsyncTeleBot шлёт большинство методов GET-запросом с телом формы
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_telegram(telegram):
+    FakeTelegramHandler.telegram = telegram
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.reason = "OK" if status_code == 200 else "Error"
+        self.text = json.dumps(data)
+        self._data = data
+
+    def json(self):
+        return self._data
+
+# Заглушка REST API Google Sheets на уровне HTTP-сессии: через неё работает
+# настоящий gspread (и предохранитель бота). Поддерживает запросы, которые
+# делает бот: метаданные, batchGet, get, append, update, batchUpdate, batchClear
+class FakeSheetsSession:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.sheets = {}  # {title: [[value, ...], ...]}
+        self.headers = {}
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        path = unquote(urlparse(url).path).split("/v4/spreadsheets", 1)[1]
+        kind = self._kind(method, path)
+        count_call("sheets", kind)
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            return self._response(503, {"error": {"code": 503, "message": "Backend Error", "status": "UNAVAILABLE"}})
+        with self.lock:
+            return self._response(200, getattr(self, "_" + kind)(path, params or {}, json or {}))
+
+    def _kind(self, method, path):
+        if path.endswith(":batchUpdate") and "/values" not in path:
+            return "sheet_batch_update"
+        for suffix, kind in ((":batchGet", "batch_get"), (":batchUpdate", "batch_update"),
+                             (":batchClear", "batch_clear"), (":append", "append")):
+            if path.endswith(suffix):
+                return kind
+        if "/values/" in path:
+            return "update" if method.lower() == "put" else "get"
+        return "metadata"
+
+    def _response(self, status_code, data):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(data).encode()
+        return response
+
+    def _sheet(self, title):
+        return self.sheets.setdefault(title, [])
+
+    # "'Users'!A5:C6" -> (title, строка, столбец, конечная строка, конечный столбец), с нуля
+    def _range(self, a1):
+        match = re.match(r"^(?:'((?:[^']|'')*)'|([^!]*))(?:!([A-Z]+)(\d+)?(?::([A-Z]+)(\d+)?)?)?$", a1)
+        title = (match.group(1) or "").replace("''", "'") or match.group(2)
+        col = column_index(match.group(3)) if match.group(3) else 0
+        row = int(match.group(4)) - 1 if match.group(4) else 0
+        end_col = column_index(match.group(5)) if match.group(5) else None
+        end_row = int(match.group(6)) - 1 if match.group(6) else None
+        return title, row, col, end_row, end_col
+
+    def _values(self, title):
+        rows = [list(row) for row in self._sheet(title)]
+        for row in rows:
+            while row and row[-1] == "":
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def _write(self, a1, values):
+        title, row, col, _, _ = self._range(a1)
+        sheet = self._sheet(title)
+        for i, values_row in enumerate(values):
+            while len(sheet) <= row + i:
+                sheet.append([])
+            target = sheet[row + i]
+            for j, value in enumerate(values_row):
+                while len(target) <= col + j:
+                    target.append("")
+                target[col + j] = str(value)
+
+    def _metadata(self, path, params, body):
+        return {
+            "spreadsheetId": "bench",
+            "properties": {"title": "Bench"},
+            "sheets": [
+                {"properties": {
+                    "sheetId": i, "title": title, "index": i, "sheetType": "GRID",
+                    "gridProperties": {"rowCount": max(len(rows), 100), "columnCount": 26},
+                }}
+                for i, (title, rows) in enumerate(self.sheets.items())
+            ],
+        }
+
+    def _sheet_batch_update(self, path, params, body):
+        replies = []
+        for request in body.get("requests", []):
+            if "addSheet" in request:
+                title = request["addSheet"]["properties"]["title"]
+                self._sheet(title)
+                replies.append({"addSheet": {"properties": {
+                    "sheetId": list(self.sheets).index(title), "title": title,
+                    "index": list(self.sheets).index(title), "sheetType": "GRID",
+                    "gridProperties": {"rowCount": 100, "columnCount": 26},
+                }}})
+            else:
+                replies.append({})
+        return {"spreadsheetId": "bench", "replies": replies}
+
+    def _batch_get(self, path, params, body):
+        ranges = params.get("ranges", [])
+        if isinstance(ranges, str):
+            ranges = [ranges]
+        return {"valueRanges": [
+            {"range": a1, "values": self._values(self._range(a1)[0])} for a1 in ranges
+        ]}
+
+    def _get(self, path, params, body):
+        a1 = path.split("/values/", 1)[1]
+        return {"range": a1, "values": self._values(self._range(a1)[0])}
+
+    def _append(self, path, params, body):
+        title = self._range(path.split("/values/", 1)[1].rsplit(":", 1)[0])[0]
+        start = len(self._values(title))
+        values = body.get("values", [])
+        self._write(f"'{title}'!A{start + 1}", values)
+        width = max((len(row) for row in values), default=1)
+        return {"updates": {
+            "updatedRange": f"'{title}'!A{start + 1}:{column_letter(width - 1)}{start + len(values)}",
+            "updatedRows": len(values),
+        }}
+
+    def _update(self, path, params, body):
+        self._write(path.split("/values/", 1)[1], body.get("values", []))
+        return {}
+
+    def _batch_update(self, path, params, body):
+        for item in body.get("data", []):
+            self._write(item["range"], item["values"])
+        return {}
+
+    def _batch_clear(self, path, params, body):
+        for a1 in body.get("ranges", []):
+            title, row, col, end_row, end_col = self._range(a1)
+            sheet = self._sheet(title)
+            for r in range(row, min(len(sheet), (end_row if end_row is not None else len(sheet) - 1) + 1)):
+                for c in range(col, min(len(sheet[r]), (end_col if end_col is not None else len(sheet[r]) - 1) + 1)):
+                    sheet[r][c] = ""
+        return {}
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+def column_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(65 + rest) + letters
+    return letters
+
+class FakeCredentials:
+    token = "bench"
+    expiry = None
+    valid = True
+
+    def refresh(self, request):
+        pass
+
+# Заглушка Tenor: локальный HTTP-сервер с ответами в формате /v2/search
+class FakeTenorHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        count_call("tenor", "search")
+        if self.latency:
+            time.sleep(self.latency)
+        page = int(re.search(r"pos=(\d+)", self.path).group(1)) if "pos=" in self.path else 0
+        body = json.dumps({
+            "results": [
+                {"id": f"gif-{page}-{i}", "media_formats": {"gif": {"url": f"https://example.com/{page}/{i}.gif"}}}
+                for i in range(50)
+            ],
+            "next": str(page + 1),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_tenor(latency):
+    FakeTenorHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTenorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v2/search"
+
+# Подмена сервисов и импорт бота. Всё, что бот делает при импорте
+# (подключение к таблице, пул мемов, потоки), идёт уже в заглушки
+def load_bot(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    storage_backend = "sqlite" if args.storage.startswith("sqlite") else "sheets"
+    os.environ.update({
+        "TOKEN": "123456:BENCH",
+        "TENOR_API_KEY": "bench",
+        "TENOR_SEARCH_URL": start_fake_tenor(args.tenor_latency),
+        "STORAGE_BACKEND": storage_backend,
+        "SQLITE_PATH": os.path.join(workdir, "bot.db"),
+        "JOURNAL_PATH": os.path.join(workdir, "journal.jsonl"),
+        "SNAPSHOT_PATH": os.path.join(workdir, "snapshot.json"),
+        "MEDIA_CACHE_PATH": os.path.join(workdir, "media_cache.json"),
+        "UPDATE_STATE_PATH": os.path.join(workdir, "update_state.json"),
+        "RAILWAY_PUBLIC_DOMAIN": "",
+    })
+    if args.storage == "sqlite":
+        os.environ.update({"GOOGLE_CREDENTIALS": "", "SPREADSHEET_ID": ""})
+    else:
+        os.environ.update({"GOOGLE_CREDENTIALS": "{}", "SPREADSHEET_ID": "bench"})
+
+    import telebot.apihelper
+    import google.auth.transport.requests
+    from google.oauth2.service_account import Credentials
+
+    telegram = FakeTelegram(args.telegram_latency, args.telegram_error_rate)
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram
+    sheets_session = FakeSheetsSession(args.sheets_latency, 0.0)
+    google.auth.transport.requests.AuthorizedSession = lambda credentials: sheets_session
+    Credentials.from_service_account_info = classmethod(lambda cls, info, **kwargs: FakeCredentials())
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    global current_command
+    current_command = bot.current_command
+    # Ошибки таблицы включаются после старта, чтобы бот успел загрузиться
+    sheets_session.error_rate = args.sheets_error_rate
+    if args.flood_limit == "off":
+        bot.flood_policy = bot.TokenBucketPolicy(10 ** 6, 10 ** 6)
+    if args.telegram_limits == "off":
+        bot.telegram_limiter = bot.TokenBucket(10 ** 6)
+        bot.TELEGRAM_CHAT_RATE = bot.TELEGRAM_CHAT_BURST = 10 ** 6
+    return bot, telegram
+
+def make_update(update_id, chat_id, user_id, text):
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Поток синтетических обновлений: регистрация участников, затем случайные
+# команды в случайных чатах с заданной частотой
+def run_load(bot, telegram, args):
+    client = bot.app.test_client()
+    url = f"/{bot.BOT_TOKEN}"
+    lock = threading.Lock()
+    sent = {}                     # {message_id: (команда, время отправки вебхука)}
+    latencies = defaultdict(list)  # {команда: [секунд до первого ответа]}
+    replies = Counter()           # {команда: ответов}
+    answered = set()              # message_id, на которые уже пришёл ответ
+    webhook_times = []
+    statuses = Counter()
+
+    def on_reply(message_id, sent_at):
+        with lock:
+            entry = sent.get(message_id)
+            if entry is None:
+                return
+            command, posted_at = entry
+            replies[command] += 1
+            if message_id not in answered:
+                answered.add(message_id)
+                latencies[command].append(sent_at - posted_at)
+    telegram.on_reply = on_reply
+    telegram.command_of = lambda message_id: sent.get(message_id, (None,))[0]
+
+    chats = [-1000000000 - i for i in range(args.chats)]
+    members = {chat_id: [chat_index * 1000 + j + 1 for j in range(args.users)] for chat_index, chat_id in enumerate(chats)}
+    stream = [(chat_id, user_id, "/register") for chat_id in chats for user_id in members[chat_id]]
+    commands, weights = zip(*COMMANDS.items())
+    total = len(stream) + int(args.rate * args.duration)
+    while len(stream) < total:
+        chat_id = random.choice(chats)
+        stream.append((chat_id, random.choice(members[chat_id]), random.choices(commands, weights)[0]))
+
+    print(f"Нагрузка: {len(stream)} обновлений, {args.chats} чатов, {args.rate} в сек.")
+    started = time.monotonic()
+    for i, (chat_id, user_id, command) in enumerate(stream, start=1):
+        delay = started + i / args.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        update = make_update(i, chat_id, user_id, command)
+        with lock:
+            sent[i] = (command, time.monotonic())
+        posted_at = time.monotonic()
+        response = client.post(url, data=json.dumps(update), content_type="application/json")
+        webhook_times.append(time.monotonic() - posted_at)
+        statuses[response.status_code] += 1
+    feed_time = time.monotonic() - started
+
+    # Ждём, пока очереди обновлений и ответов опустеют
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        if not bot.dispatcher.metrics()["depth"] and not bot.outbox.metrics()["depth"]:
+            break
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    per_command = Counter(command for command, _ in sent.values())
+    print()
+    print(f"Отправлено за {feed_time:.1f} сек. ({len(stream) / feed_time:.0f} в сек.), "
+          f"обработано за {elapsed:.1f} сек. ({len(stream) / elapsed:.0f} в сек.)")
+    print(f"Ответы вебхука: {dict(statuses)}; p50 {percentile(webhook_times, 50) * 1000:.1f} мс, "
+          f"p99 {percentile(webhook_times, 99) * 1000:.1f} мс")
+    print()
+    print(f"{'команда':<12}{'команд':>8}{'ответов':>9}{'без отв.':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for command in COMMANDS:
+        values = latencies[command]
+        print(f"{command:<12}{per_command[command]:>8}{replies[command]:>9}{per_command[command] - len(values):>9}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+
+    # Вызовы API по командам на момент, когда очереди опустели
+    with api_calls_lock:
+        calls = sorted(api_calls.items())
+    print()
+    print(f"{'команда':<12}{'сервис':<10}{'метод':<22}{'вызовов':>8}{'на команду':>12}")
+    for command in list(COMMANDS) + [BACKGROUND]:
+        for (call_command, service, method), count in calls:
+            if call_command == command:
+                per = f"{count / per_command[command]:.2f}" if per_command[command] else "—"
+                print(f"{command:<12}{service:<10}{method:<22}{count:>8}{per:>12}")
+
+# Рассылка мемов во все чаты из реестра через планировщик бота: у каждого
+# чата своё время в пределах window секунд (0 — все чаты разом)
+def run_memes(bot, window, timeout):
+    bot.meme_pool.refresh()
+    chat_ids = list(bot.users.keys())
+    started = time.time()
+    for chat_id in chat_ids:
+        bot.scheduler.at(started + random.random() * window, bot.send_chat_meme, chat_id, key=("meme", chat_id))
+
+    def done():
+        with bot.metrics.lock:
+            return sum(value for (name, _), value in bot.metrics.counters.items() if name == "bot_memes_total")
+
+    while done() < len(chat_ids) and time.time() - started < window + timeout:
+        time.sleep(0.05)
+    with bot.metrics.lock:
+        results = {dict(labels)["result"]: value for (name, labels), value in bot.metrics.counters.items()
+                   if name == "bot_memes_total"}
+    print(f"Рассылка мемов: {len(chat_ids)} чатов за {window:g} сек. окна, {results}, "
+          f"{time.time() - started:.1f} сек.")
+
+def report_api_calls(bot):
+    bot.storage.flush()
+    print()
+    print("Вызовы API:")
+    totals = Counter()
+    with api_calls_lock:
+        for (_, service, method), count in api_calls.items():
+            totals[(service, method)] += count
+    for (service, method), count in sorted(totals.items()):
+        print(f"  {service:<10}{method:<22}{count:>8}")
+    if bot.SHEETS_ENABLED:
+        print(f"Предохранитель Google Sheets: {bot.sheets_breaker.metrics()}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--storage", choices=["sheets", "sqlite", "sqlite+sheets"], default="sheets")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=5, help="участников в каждом чате")
+    parser.add_argument("--rate", type=float, default=100, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="секунд нагрузки после регистрации")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--telegram-limits", choices=["on", "off"], default="on",
+                        help="off — снять лимиты Telegram бота, чтобы мерить собственную пропускную способность")
+    parser.add_argument("--flood-limit", choices=["on", "off"], default="on",
+                        help="off — не отбрасывать команды участников как флуд")
+    parser.add_argument("--sheets-latency", type=float, default=0.1)
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--tenor-latency", type=float, default=0.05)
+    parser.add_argument("--memes", action="store_true", help="после нагрузки выполнить рассылку мемов")
+    parser.add_argument("--meme-window", type=float, default=10,
+                        help="секунд, на которые распределяются мемы чатов (0 — все разом)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    bot, telegram = load_bot(args)
+    run_load(bot, telegram, args)
+    if args.memes:
+        run_memes(bot, args.meme_window, args.drain_timeout)
+    report_api_calls(bot)
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,25 @@ import time
 import json
 import os
 import threading
-import schedule
+import queue
+import sqlite3
+import re
+import atexit
 import requests
 import datetime
+import functools
+import io
+import sys
+import asyncio
+import heapq
+import itertools
+import socket
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import gspread
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from google.auth.transport.requests import AuthorizedSession, Request
 from flask import Flask, request
 
 # Инициализация Flask для вебхуков
@@ -22,6 +34,23 @@ TENOR_API_KEY = os.getenv("TENOR_API_KEY")
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 RAILWAY_PUBLIC_DOMAIN = os.getenv("RAILWAY_PUBLIC_DOMAIN")
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Хранилище: "sheets" — Google Sheets как основное хранилище,
+# "sqlite" — локальная база, Google Sheets (если настроен) — асинхронная реплика
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+SHEETS_ENABLED = bool(GOOGLE_CREDENTIALS and SPREADSHEET_ID)
+SHEETS_PRIMARY = STORAGE_BACKEND != "sqlite"
+
+# Несколько экземпляров бота: общая база SQLite (SQLITE_PATH) и координатор
+# в REPLICA_DB — лидер для задач планировщика и лента изменений между репликами
+REPLICA_DB = os.getenv("REPLICA_DB", "")  # пусто — единственный экземпляр
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Режим выполнения: "threads" — TeleBot, requests и Flask в потоках,
+# "asyncio" — AsyncTeleBot и aiohttp в одном цикле событий
+RUNTIME = os.getenv("RUNTIME", "threads").lower()
 
 # Проверка переменных окружения
 print(f"BOT_TOKEN: {'Set' if BOT_TOKEN else 'Not set'}")
@@ -29,64 +58,694 @@ print(f"TENOR_API_KEY: {'Set' if TENOR_API_KEY else 'Not set'}")
 print(f"GOOGLE_CREDENTIALS: {GOOGLE_CREDENTIALS[:50] if GOOGLE_CREDENTIALS else 'Not set'}...")
 print(f"SPREADSHEET_ID: {SPREADSHEET_ID if SPREADSHEET_ID else 'Not set'}")
 print(f"RAILWAY_PUBLIC_DOMAIN: {RAILWAY_PUBLIC_DOMAIN if RAILWAY_PUBLIC_DOMAIN else 'Not set'}")
+print(f"STORAGE_BACKEND: {STORAGE_BACKEND}")
+print(f"REPLICA_DB: {REPLICA_DB if REPLICA_DB else 'Not set'}")
+print(f"RUNTIME: {RUNTIME}")
 
-# Проверка, что все переменные заданы
-if not all([BOT_TOKEN, TENOR_API_KEY, GOOGLE_CREDENTIALS, SPREADSHEET_ID]):
+# Проверка, что все переменные заданы (без Google Sheets можно работать только с sqlite)
+if not all([BOT_TOKEN, TENOR_API_KEY]) or (SHEETS_PRIMARY and not SHEETS_ENABLED):
     print("Ошибка: Одна или несколько переменных окружения не заданы")
     exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Реплики делят состояние через общую базу, Google Sheets для этого не годится
+if REPLICA_DB and SHEETS_PRIMARY:
+    print("Ошибка: REPLICA_DB работает только с STORAGE_BACKEND=sqlite")
+    exit(1)
+
+# Обработчики вызываются из собственных воркеров (UpdateDispatcher), а не из пула TeleBot
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
 # Настройки Google Sheets
 STATS_SHEET_NAME = "Sheet1"
 USERS_SHEET_NAME = "Users"
 LAST_CHOICE_SHEET_NAME = "LastChoice"
+GOOGLE_SCOPES = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/spreadsheets",
+]
+GOOGLE_POOL_SIZE = 8             # HTTP-соединений к Google API в пуле
+GOOGLE_TOKEN_REFRESH_MARGIN = 300  # секунд: токен обновляется заранее, до истечения
+
+# Предохранитель (circuit breaker) для Google Sheets
+SHEETS_BREAKER_WINDOW = 20        # последних запросов для оценки доли ошибок
+SHEETS_BREAKER_MIN_CALLS = 5      # меньше запросов в окне — не размыкаем
+SHEETS_BREAKER_FAILURE_RATE = 0.5 # доля ошибок, при которой цепь размыкается
+SHEETS_BREAKER_SLOW_CALL = 5      # секунд: более медленный запрос считается ошибкой
+SHEETS_BREAKER_OPEN_TIME = 30     # секунд без запросов к Sheets до пробного запроса
+
+# Настройки фоновой записи статистики
+STATS_FLUSH_INTERVAL = 5   # секунд между сбросами очереди в Google Sheets
+STATS_BATCH_SIZE = 50      # сброс раньше интервала, если накопилось столько строк
+STATS_MAX_BACKOFF = 300    # максимальная пауза после ошибок/превышения квоты
+LAST_CHOICE_SAVE_DELAY = 2  # секунд: частые обновления кд склеиваются в одну запись
+USERS_SAVE_DELAY = 1        # секунд: регистрации склеиваются в одну запись
+
+# Локальный журнал неподтверждённых изменений
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "journal.jsonl")
+JOURNAL_FSYNC_INTERVAL = 0.2  # секунд между fsync журнала
+JOURNAL_DEDUP_ROWS = 1000     # сколько последних строк Sheet1 сверять при проигрывании
+
+# Локальный снимок состояния для быстрого старта (основное хранилище — Google Sheets)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshot.json")
+SNAPSHOT_INTERVAL = 5         # минут между сохранениями снимка
+
+# Рассылка мемов и лимиты Telegram
+TENOR_SEARCH_URL = os.getenv("TENOR_SEARCH_URL", "https://tenor.googleapis.com/v2/search")
+HTTP_TIMEOUT = 10             # секунд на запрос к внешним API
+MEME_WORKERS = 8              # параллельных запросов к Telegram при отправке мемов
+TELEGRAM_GLOBAL_RATE = 30     # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = 1        # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3       # сообщений подряд в один чат без ожидания
+TELEGRAM_MAX_RETRIES = 3      # повторов после 429 Too Many Requests
+TELEGRAM_CHAT_IDLE = 600      # секунд: лимит чата без отправок забывается
+
+# Пул GIF из Tenor, обновляемый в фоне
+MEME_QUERY = "funny"
+MEME_PAGE_SIZE = 50           # результатов на страницу Tenor
+MEME_POOL_PAGES = 4           # страниц за одно обновление пула
+MEME_POOL_SIZE = 400          # максимум GIF в пуле, старые вытесняются
+MEME_POOL_TTL = 12 * 3600     # секунд жизни GIF в пуле
+MEME_POOL_REFRESH = 3600      # секунд между обновлениями пула
+MEME_HISTORY_SIZE = 100       # последних GIF на чат, которые не повторяем
+MEME_PLAN_TIME = "05:55"      # ежедневное планирование рассылки
+MEME_DAY_START = datetime.time(6, 0)    # у каждого чата своё время мема в этом окне
+MEME_DAY_END = datetime.time(23, 59)
+
+# Планировщик задач
+SCHEDULER_WORKERS = MEME_WORKERS  # задач, выполняемых одновременно
+SCHEDULER_COMPACT_MIN = 1000      # отменённых записей в куче до её перестройки
+
+# Кэш file_id Telegram для уже загруженных GIF
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+MEDIA_CACHE_SIZE = 2000       # записей, самые давно использованные вытесняются
+MEDIA_CACHE_SAVE_DELAY = 30   # секунд: изменения кэша сохраняются на диск пачкой
+
+# Очередь входящих обновлений
+UPDATE_WORKERS = 8            # потоков обработки обновлений
+UPDATE_QUEUE_LIMIT = 1000     # максимум необработанных обновлений всего
+UPDATE_CHAT_QUEUE_LIMIT = 50  # максимум необработанных обновлений одного чата
+POLLING_TIMEOUT = 20          # секунд long polling
+UPDATE_DEDUP_SIZE = 10000     # последних update_id в памяти для отсева повторов
+UPDATE_DEDUP_TTL = 24 * 3600  # секунд: столько Telegram может повторять доставку
+UPDATE_STATE_PATH = os.getenv("UPDATE_STATE_PATH", "update_state.json")  # пусто — не сохранять
+UPDATE_STATE_SAVE_DELAY = 1   # секунд: запись максимального update_id склеивается
+
+# Координация реплик (REPLICA_DB)
+LEADER_LEASE = 15             # секунд: аренда лидерства без продления истекает
+LEADER_RENEW_INTERVAL = 5     # секунд между продлениями аренды
+REPLICA_SYNC_INTERVAL = 1     # секунд между чтениями ленты изменений
+REPLICA_SYNC_BATCH = 500      # записей ленты за одно чтение
+REPLICA_CHANGES_TTL = 3600    # секунд хранения ленты изменений и договорённостей
+REPLICA_IMPORT_WAIT = 300     # секунд: реплика ждёт импорт Google Sheets, начатый другой
+
+# Очередь исходящих сообщений
+OUTBOX_WORKERS = 4            # потоков отправки
+OUTBOX_QUEUE_LIMIT = 5000     # максимум неотправленных сообщений всего
+OUTBOX_CHAT_QUEUE_LIMIT = 100 # максимум неотправленных сообщений одного чата
+OUTBOX_COALESCE = os.getenv("OUTBOX_COALESCE", "0") == "1"  # склеивать подряд идущие ответы чату
+
+# Асинхронный режим (RUNTIME=asyncio)
+ASYNC_EXECUTOR_WORKERS = 8    # потоков для обработчиков команд, SQLite и Google Sheets
+ASYNC_UPDATE_LIMIT = 10000    # обновлений в обработке одновременно
+TELEGRAM_MESSAGE_LIMIT = 4096 # символов в одном сообщении
+
+# Ограничения частоты команд
+CHOOSE_COOLDOWN = 86400       # секунд между /choose в одном чате
+AGR_COOLDOWN = 86400          # секунд между /agr в одном чате
+FLOOD_BURST = 5               # команд подряд от одного участника
+FLOOD_RATE = 0.2              # команд в секунду от участника в долгую
+REGISTER_REPEAT_WINDOW = 3600 # секунд: вежливый ответ на повторный /register раз в окно
+RATE_LIMIT_MAX_KEYS = 100000  # максимум ключей в памяти, старые вытесняются
+
+# Профилировщик (/profile, только ADMIN_IDS)
+PROFILE_INTERVAL = 0.005      # секунд между снимками стеков
+PROFILE_DEFAULT_UPDATES = 50  # команд по умолчанию
+PROFILE_MAX_SECONDS = 300     # профилирование не дольше
+PROFILE_TOP = 10              # строк в итоговом сообщении
+
+# Состояние бота в памяти
+STATE_SHARDS = 32             # шардов (блокировок) в словарях состояния по chat_id
+
+# Словарь, разбитый на шарды по ключу (chat_id): у каждого шарда своя
+# блокировка, поэтому разные чаты не конкурируют за одну глобальную.
+# keys()/items()/values() возвращают снимок — итерация не ломается от
+# параллельных изменений. Значения меняются заменой или, как ChatMembers,
+# только дописыванием, поэтому читатели снимка не блокируют писателей
+class ShardedDict:
+    def __init__(self, shards=STATE_SHARDS):
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.RLock() for _ in range(shards)]
+
+    def _index(self, key):
+        return hash(key) % len(self.shards)
+
+    # Блокировка шарда ключа — для составных операций над одним чатом
+    def lock(self, key):
+        return self.locks[self._index(key)]
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        with self.locks[i]:
+            return self.shards[i][key]
+
+    def __setitem__(self, key, value):
+        i = self._index(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
+
+    def __contains__(self, key):
+        i = self._index(key)
+        with self.locks[i]:
+            return key in self.shards[i]
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        with self.locks[i]:
+            return self.shards[i].get(key, default)
+
+    def setdefault(self, key, default=None):
+        i = self._index(key)
+        with self.locks[i]:
+            return self.shards[i].setdefault(key, default)
+
+    def pop(self, key, default=None):
+        i = self._index(key)
+        with self.locks[i]:
+            return self.shards[i].pop(key, default)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __bool__(self):
+        return any(self.shards)
+
+    def items(self):
+        snapshot = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                snapshot.extend(shard.items())
+        return snapshot
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    # Полная замена содержимого, шард за шардом
+    def replace(self, data):
+        parts = [{} for _ in self.shards]
+        for key, value in data.items():
+            parts[self._index(key)][key] = value
+        for shard, lock, part in zip(self.shards, self.locks, parts):
+            with lock:
+                shard.clear()
+                shard.update(part)
+
+    # Слияние значений, которые могут только расти (время кд)
+    def update_max(self, data):
+        for key, value in data.items():
+            with self.lock(key):
+                self[key] = max(value, self.get(key, value))
+
+# Метрики в текстовом формате Prometheus для /metrics: счётчики и
+# гистограммы длительностей с метками. Запись — словарь под одной
+# блокировкой, без аллокаций строк на горячем пути; текст собирается при запросе
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}    # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [счётчики по корзинам..., сумма, количество]}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    # Текст для Prometheus. gauges и extra_counters — {(name, labels): value},
+    # значения, которые считаются в момент запроса
+    def render(self, gauges, extra_counters=None):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        counters.update(extra_counters or {})
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+
+# Учёт внешнего вызова: длительность по цели и методу, ошибки отдельно
+def observe_call(target, method, started, ok=True):
+    labels = (("target", target), ("method", method))
+    metrics.observe("bot_external_call_duration_seconds", time.perf_counter() - started, labels)
+    if not ok:
+        metrics.inc("bot_external_call_errors_total", labels)
+
+# Семплирующий профилировщик обработчиков и задач планировщика. Пока он
+# выключен, обработчики проверяют только один флаг. Во время работы поток
+# снимает стеки потоков, выполняющих команды/задачи, и агрегирует их по
+# метке (команде или задаче) в формате collapsed stacks для flamegraph
+class Profiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = False
+        self.threads = {}  # {ident потока: метка}
+        self.stacks = {}   # {"метка;файл:функция;...": число снимков}
+        self.remaining = 0
+        self.deadline = 0
+        self.chat_id = None
+
+    # Начать профилирование следующих updates команд, но не дольше seconds
+    def start(self, chat_id, updates=None, seconds=PROFILE_MAX_SECONDS):
+        with self.lock:
+            if self.active:
+                return False
+            self.active = True
+            self.threads = {}
+            self.stacks = {}
+            self.remaining = updates
+            self.deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            self.chat_id = chat_id
+        threading.Thread(target=self._sample, name="profiler", daemon=True).start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            self.deadline = 0
+
+    # Выполнить func с записью стеков под меткой label
+    def run(self, label, func, *args, counted=True):
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] = label
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.threads.pop(ident, None)
+                if counted and self.remaining:
+                    self.remaining -= 1
+                    if not self.remaining:
+                        self.deadline = 0
+
+    def _sample(self):
+        while True:
+            with self.lock:
+                if time.monotonic() >= self.deadline:
+                    self.active = False
+                    break
+                threads = dict(self.threads)
+            frames = sys._current_frames()
+            for ident, label in threads.items():
+                frame = frames.get(ident)
+                stack = []
+                # Стек от обработчика: кадры ниже Profiler.run не нужны
+                while frame is not None and frame.f_code is not Profiler.run.__code__:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = ";".join([label] + stack[::-1])
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+        self._report()
+
+    # Итог: сводка по меткам и самым частым функциям + файл для flamegraph
+    def _report(self):
+        with self.lock:
+            stacks = dict(self.stacks)
+            chat_id = self.chat_id
+        by_label = {}
+        by_function = {}
+        for key, count in stacks.items():
+            frames = key.split(";")
+            by_label[frames[0]] = by_label.get(frames[0], 0) + count
+            by_function[frames[-1]] = by_function.get(frames[-1], 0) + count
+        total = sum(stacks.values())
+        lines = [f"Профиль: {total} снимков по {self.interval * 1000:.0f} мс"]
+        for label, count in sorted(by_label.items(), key=lambda item: -item[1]):
+            lines.append(f"{label}: {count} ({count * self.interval:.2f} сек.)")
+        lines.append("")
+        lines.append("Самые частые функции:")
+        for function, count in sorted(by_function.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+            lines.append(f"{count * 100 / total:.1f}% {function}")
+        print("\n".join(lines))
+        if chat_id is None:
+            return
+        try:
+            telegram_call(bot.send_message, chat_id, "\n".join(lines) if total else "Профиль пуст: команд не было")
+            if total:
+                folded = "".join(f"{key} {count}\n" for key, count in sorted(stacks.items()))
+                document = telebot.types.InputFile(io.BytesIO(folded.encode("utf-8")), file_name=f"profile-{int(time.time())}.folded")
+                telegram_call(bot.send_document, chat_id, document)
+        except Exception as e:
+            print(f"Ошибка отправки профиля: {e}")
+
+profiler = Profiler()
+
+# Участник чата: запись со слотами вместо словаря
+class Member:
+    __slots__ = ("id", "name")
+
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+# Участники одного чата: массив записей и индекс {user_id: позиция}.
+# Проверка участия, случайный участник (в том числе «кроме X») и пара
+# разных участников — O(1). Участники не удаляются, запись только
+# дописывается в конец или заменяется целиком (смена имени), поэтому
+# читатели обходятся без блокировки; писатели держат users.lock(chat_id)
+class ChatMembers:
+    __slots__ = ("members", "index")
+
+    def __init__(self, records=()):
+        self.members = []
+        self.index = {}
+        for record in records:
+            self.upsert(record["id"], record["name"])
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def get(self, user_id):
+        position = self.index.get(user_id)
+        return None if position is None else self.members[position]
+
+    # Добавить участника или сменить имя. True — если что-то изменилось
+    def upsert(self, user_id, name):
+        position = self.index.get(user_id)
+        if position is None:
+            self.index[user_id] = len(self.members)
+            self.members.append(Member(user_id, name))
+            return True
+        if self.members[position].name == name:
+            return False
+        self.members[position] = Member(user_id, name)
+        return True
+
+    # Случайный участник, кроме exclude (если он в чате). None — выбрать некого
+    def random(self, exclude=None):
+        members = self.members
+        count = len(members)
+        skip = self.index.get(exclude)
+        if skip is None:
+            return random.choice(members) if count else None
+        if count < 2:
+            return None
+        position = random.randrange(count - 1)
+        return members[position + 1 if position >= skip else position]
+
+    # Два разных случайных участника (нужно минимум два)
+    def random_pair(self):
+        members = self.members
+        count = len(members)
+        first = random.randrange(count)
+        second = random.randrange(count - 1)
+        if second >= first:
+            second += 1
+        return members[first], members[second]
+
+    # Формат хранилищ и снимка: [{"id": ..., "name": ...}]
+    def records(self):
+        return [{"id": member.id, "name": member.name} for member in self.members]
+
+# Реестр в формате хранилищ {chat_id: [{"id": ..., "name": ...}]} -> память
+def members_from_records(loaded):
+    return {chat_id: ChatMembers(records) for chat_id, records in loaded.items()}
+
+def users_records():
+    return {chat_id: members.records() for chat_id, members in users.items()}
 
 # Глобальные переменные
 sheets = {"stats": None, "users": None, "last_choice": None}
-users = {}
-last_choice = {}  # Хранит время последнего /choose для каждого чата
-last_agr = {}     # Хранит время последнего /agr для каждого чата
-stats_cache = []
-register_attempts = {}  # Хранит количество попыток регистрации: {chat_id: {user_id: count}}
-
-# Проверка существования таблицы
-def check_spreadsheet_exists(creds):
-    try:
-        print(f"Проверка существования таблицы: {SPREADSHEET_ID}")
-        service = build("sheets", "v4", credentials=creds)
-        response = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-        print(f"Таблица {SPREADSHEET_ID} существует: {response['properties']['title']}")
-        return True
-    except HttpError as e:
-        error_details = json.loads(e.content.decode()) if e.content else {}
-        print(f"Ошибка проверки таблицы {SPREADSHEET_ID}: {str(e)}, детали: {error_details}")
-        return False
-    except Exception as e:
-        print(f"Неожиданная ошибка при проверке таблицы {SPREADSHEET_ID}: {str(e)}")
-        return False
+users = ShardedDict()        # {chat_id: ChatMembers}
+last_choice = ShardedDict()  # Хранит время последнего /choose для каждого чата
+last_agr = ShardedDict()     # Хранит время последнего /agr для каждого чата
+stats_cache = []  # Строки статистики, ещё не записанные в Google Sheets (по порядку)
+stats_aggregates = ShardedDict()  # Агрегаты статистики: {chat_id: ChatStats}
+stats_loaded = False  # Агрегаты построены по данным из хранилища
+recent_stats_rows = set()  # Последние строки Sheet1, для проверки дублей при проигрывании журнала
+sheets_prefetched = {}  # Листы, прочитанные при подключении одним batchGet: {"users": [[...], ...]}
+sheets_loaded = threading.Event()  # Данные из Google Sheets загружены, журнал проигран
+snapshot_loaded = False  # Состояние восстановлено из локального снимка
+snapshot_stats_marks = {}  # По снимку: {chat_id: дата последней строки, уже учтённой в агрегатах}
+users_rows = {}   # Номер строки листа Users: {(chat_id, user_id): row}
+users_dirty = {}  # Несохранённые регистрации/имена: {(chat_id, user_id): username}
+users_sync_lock = threading.Lock()   # короткие операции с реестром и индексом строк
+users_flush_lock = threading.RLock()  # одновременно пишет/читает лист только один поток
+last_choice_rows = {}     # Номер строки листа LastChoice: {chat_id: row}
+last_choice_dirty = set()  # Чаты с несохранёнными кд
+last_choice_sync_lock = threading.Lock()   # короткие операции с кд и индексом строк
+last_choice_flush_lock = threading.Lock()  # одновременно пишет только один сброс
+
+# Цепь разомкнута: запрос не отправлялся
+class CircuitOpenError(Exception):
+    pass
+
+# Предохранитель: считает ошибки и медленные запросы в скользящем окне.
+# closed — запросы идут; open — запросы сразу отклоняются, пока не пройдёт
+# open_time; half_open — пропускается один пробный запрос: успех замыкает
+# цепь, ошибка снова размыкает
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, window=SHEETS_BREAKER_WINDOW, min_calls=SHEETS_BREAKER_MIN_CALLS,
+                 failure_rate=SHEETS_BREAKER_FAILURE_RATE, slow_call=SHEETS_BREAKER_SLOW_CALL,
+                 open_time=SHEETS_BREAKER_OPEN_TIME, is_failure=None):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_time = open_time
+        self.is_failure = is_failure or (lambda e: True)
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=window)  # True — успешный запрос
+        self.opened_at = 0
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latency = 0.0  # скользящее среднее, секунд
+
+    # Цепь разомкнута и время пробного запроса ещё не пришло
+    def is_open(self):
+        with self.lock:
+            return self.state == self.OPEN and time.time() - self.opened_at < self.open_time
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.open_time:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.probing:
+                self.rejected += 1
+                return False
+            self.probing = True
+            return True
+
+    def record(self, ok, elapsed):
+        with self.lock:
+            self.calls += 1
+            self.latency = elapsed if self.calls == 1 else self.latency * 0.9 + elapsed * 0.1
+            if elapsed >= self.slow_call:
+                ok = False
+            if not ok:
+                self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                    print(f"{self.name}: пробный запрос успешен, цепь замкнута")
+                else:
+                    self._open()
+                return
+            self.outcomes.append(ok)
+            if (self.state == self.CLOSED and len(self.outcomes) >= self.min_calls
+                    and self.outcomes.count(False) / len(self.outcomes) >= self.failure_rate):
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        print(f"{self.name}: слишком много ошибок, цепь разомкнута на {self.open_time} сек.")
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} временно недоступен")
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record(not self.is_failure(e), time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+        return result
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "latency": round(self.latency, 3),
+            }
+
+# Сбой Google Sheets, а не ошибка запроса: квота, 5xx, сеть, таймаут
+def is_sheets_outage(e):
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code == 429 or e.code >= 500
+    return True
+
+sheets_breaker = CircuitBreaker("Google Sheets", is_failure=is_sheets_outage)
+
+# HTTP-клиент gspread, пропускающий каждый запрос через предохранитель
+class BreakerHTTPClient(gspread.http_client.HTTPClient):
+    def request(self, method, endpoint, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = sheets_breaker.call(super().request, method, endpoint, *args, **kwargs)
+        except Exception:
+            observe_call("sheets", method.lower(), started, ok=False)
+            raise
+        observe_call("sheets", method.lower(), started)
+        return response
+
+# Лист подключён и цепь не разомкнута
+def sheets_available(name):
+    return bool(sheets[name]) and not sheets_breaker.is_open()
+
+# Общий пул клиентов Google: GOOGLE_CREDENTIALS разбирается один раз,
+# токен обновляется заранее в фоне, а все вызовы (листы, переподключение,
+# админ-команды) идут через одну сессию с keep-alive соединениями
+class GoogleClients:
+    def __init__(self, credentials_json, pool_size=GOOGLE_POOL_SIZE):
+        self.credentials_json = credentials_json
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.creds = None
+        self.session = None
+        self.client = None
+
+    # Клиент gspread; создаётся при первом обращении
+    def sheets_client(self):
+        with self.lock:
+            if self.client is None:
+                print("Попытка парсинга GOOGLE_CREDENTIALS")
+                creds = Credentials.from_service_account_info(
+                    json.loads(self.credentials_json), scopes=GOOGLE_SCOPES
+                )
+                print("GOOGLE_CREDENTIALS успешно распарсен")
+                print("Попытка авторизации Google Sheets")
+                session = AuthorizedSession(creds)
+                session.mount("https://", requests.adapters.HTTPAdapter(
+                    pool_connections=4, pool_maxsize=self.pool_size
+                ))
+                client = gspread.Client(creds, session=session, http_client=BreakerHTTPClient)
+                client.set_timeout(HTTP_TIMEOUT)
+                self.creds, self.session, self.client = creds, session, client
+                print("Google Sheets авторизация успешна")
+            return self.client
+
+    # Запрос к Google API через общую сессию; ошибки — gspread.exceptions.APIError
+    def request(self, method, url, **kwargs):
+        return self.sheets_client().http_client.request(method, url, **kwargs).json()
+
+    # Обновление токена, если он истекает в ближайшие margin секунд, чтобы
+    # запросы не ждали обмена токена
+    def refresh(self, margin=GOOGLE_TOKEN_REFRESH_MARGIN):
+        with self.lock:
+            creds, session = self.creds, self.session
+        if creds is None:
+            return
+        expiry = creds.expiry
+        if creds.token and expiry and (expiry - datetime.datetime.utcnow()).total_seconds() > margin:
+            return
+        try:
+            creds.refresh(Request(session))
+        except Exception as e:
+            print(f"Ошибка обновления токена Google: {e}")
+
+google_clients = GoogleClients(GOOGLE_CREDENTIALS)
 
 # Проверка статуса Google Sheets API
-def check_sheets_api(creds):
+def check_sheets_api():
     try:
-        service = build("sheets", "v4", credentials=creds)
-        service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
+        google_clients.request("get", gspread.urls.SPREADSHEET_URL % SPREADSHEET_ID, params={"fields": "spreadsheetId"})
         return "Google Sheets API активен, таблица доступна."
-    except HttpError as e:
-        error_details = json.loads(e.content.decode()) if e.content else {}
-        return f"Ошибка Google Sheets API: {str(e)}, детали: {error_details}"
+    except gspread.exceptions.APIError as e:
+        return f"Ошибка Google Sheets API: {str(e)}, детали: {e.error}"
     except Exception as e:
         return f"Неожиданная ошибка проверки API: {str(e)}"
 
 # Создание новой таблицы
-def create_new_spreadsheet(creds):
+def create_new_spreadsheet():
     try:
         print("Попытка создания новой таблицы")
-        service = build("sheets", "v4", credentials=creds)
         spreadsheet = {
             "properties": {"title": f"BotStats_{int(time.time())}"}
         }
-        response = service.spreadsheets().create(body=spreadsheet).execute()
+        response = google_clients.request("post", gspread.urls.SPREADSHEETS_API_V4_BASE_URL, json=spreadsheet)
         new_spreadsheet_id = response["spreadsheetId"]
         print(f"Создана новая таблица: {new_spreadsheet_id}")
         return new_spreadsheet_id
@@ -94,64 +753,80 @@ def create_new_spreadsheet(creds):
         print(f"Ошибка создания новой таблицы: {str(e)}")
         return None
 
+# Таблица gspread, запоминающая метаданные: gspread читает их уже при
+# открытии, и список листов строится по тем же данным, без второго запроса
+class SheetsWorkbook(gspread.Spreadsheet):
+    def fetch_sheet_metadata(self, params=None):
+        self.metadata = super().fetch_sheet_metadata(params)
+        return self.metadata
+
+    def prefetched_worksheets(self):
+        return [
+            gspread.Worksheet(self, sheet["properties"], self.id, self.client)
+            for sheet in self.metadata["sheets"]
+        ]
+
 # Инициализация Google Sheets
 def init_sheets():
     try:
-        print("Попытка парсинга GOOGLE_CREDENTIALS")
-        creds_dict = json.loads(GOOGLE_CREDENTIALS)
-        print("GOOGLE_CREDENTIALS успешно распарсен")
-        creds = Credentials.from_service_account_info(
-            creds_dict,
-            scopes=[
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive",
-                "https://www.googleapis.com/auth/spreadsheets",
-            ],
-        )
-        print("Попытка авторизации Google Sheets")
-        client = gspread.authorize(creds)
-        print("Google Sheets авторизация успешна")
+        client = google_clients.sheets_client()
 
-        # Проверка существования таблицы
-        if not check_spreadsheet_exists(creds):
+        # Метаданные таблицы (название и список листов) — одним запросом
+        print(f"Попытка открытия таблицы: {SPREADSHEET_ID}")
+        try:
+            workbook = SheetsWorkbook(client.http_client, {"id": SPREADSHEET_ID})
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 404:
+                raise
             print(f"Таблица {SPREADSHEET_ID} недоступна или не существует")
             return None
-
-        print(f"Попытка открытия таблицы: {SPREADSHEET_ID}")
-        workbook = client.open_by_key(SPREADSHEET_ID)
-        print(f"Таблица открыта: {SPREADSHEET_ID}")
+        print(f"Таблица открыта: {SPREADSHEET_ID} ({workbook.title})")
 
         # Проверяем/создаём листы
-        try:
-            stats_sheet = workbook.worksheet(STATS_SHEET_NAME)
-            print(f"Лист {STATS_SHEET_NAME} найден")
-        except gspread.exceptions.WorksheetNotFound:
-            stats_sheet = workbook.add_worksheet(title=STATS_SHEET_NAME, rows=100, cols=10)
-            print(f"Создан лист: {STATS_SHEET_NAME}")
-        try:
-            users_sheet = workbook.worksheet(USERS_SHEET_NAME)
-            print(f"Лист {USERS_SHEET_NAME} найден")
-        except gspread.exceptions.WorksheetNotFound:
-            users_sheet = workbook.add_worksheet(title=USERS_SHEET_NAME, rows=100, cols=10)
-            print(f"Создан лист: {USERS_SHEET_NAME}")
-        try:
-            last_choice_sheet = workbook.worksheet(LAST_CHOICE_SHEET_NAME)
-            print(f"Лист {LAST_CHOICE_SHEET_NAME} найден")
-        except gspread.exceptions.WorksheetNotFound:
-            last_choice_sheet = workbook.add_worksheet(title=LAST_CHOICE_SHEET_NAME, rows=100, cols=10)
-            print(f"Создан лист: {LAST_CHOICE_SHEET_NAME}")
+        worksheets = {worksheet.title: worksheet for worksheet in workbook.prefetched_worksheets()}
+        for title in (STATS_SHEET_NAME, USERS_SHEET_NAME, LAST_CHOICE_SHEET_NAME):
+            if title in worksheets:
+                print(f"Лист {title} найден")
+            else:
+                worksheets[title] = workbook.add_worksheet(title=title, rows=100, cols=10)
+                print(f"Создан лист: {title}")
+        stats_sheet = worksheets[STATS_SHEET_NAME]
+        users_sheet = worksheets[USERS_SHEET_NAME]
+        last_choice_sheet = worksheets[LAST_CHOICE_SHEET_NAME]
+
+        # Все три листа целиком одним запросом: по ним проверяем заголовки,
+        # и их же используют load_users/load_last_choice/load_stats
+        response = workbook.values_batch_get(
+            [f"'{title}'" for title in (STATS_SHEET_NAME, USERS_SHEET_NAME, LAST_CHOICE_SHEET_NAME)]
+        )
+        stats_data, users_data, last_choice_data = [
+            gspread.utils.fill_gaps(value_range["values"]) if value_range.get("values") else []
+            for value_range in response["valueRanges"]
+        ]
 
         # Проверяем/создаем заголовки
-        if not stats_sheet.get("A1:D1"):
-            stats_sheet.append_row(["Дата", "User ID", "Username", "Статус"])
+        if not stats_data or not any(stats_data[0][:5]):
+            stats_sheet.append_row(["Дата", "User ID", "Username", "Статус", "Chat ID"])
+            stats_data = [["Дата", "User ID", "Username", "Статус", "Chat ID"]] + stats_data
             print("Заголовки добавлены в Sheet1")
-        if not users_sheet.get("A1:C1"):
+        elif len(stats_data[0]) < 5 or not stats_data[0][4]:
+            stats_sheet.update(values=[["Chat ID"]], range_name="E1")
+            print("Добавлен столбец Chat ID в Sheet1")
+        if not users_data or not any(users_data[0][:3]):
             users_sheet.append_row(["Chat ID", "User ID", "Username"])
+            users_data = [["Chat ID", "User ID", "Username"]] + users_data
             print("Заголовки добавлены в Users")
-        if not last_choice_sheet.get("A1:C1"):
+        if not last_choice_data or not any(last_choice_data[0][:3]):
             last_choice_sheet.append_row(["Chat ID", "Choose Timestamp", "Agr Timestamp"])
+            last_choice_data = [["Chat ID", "Choose Timestamp", "Agr Timestamp"]] + last_choice_data
             print("Заголовки добавлены в LastChoice")
 
+        sheets_prefetched.clear()
+        sheets_prefetched.update({
+            "stats": stats_data,
+            "users": users_data,
+            "last_choice": last_choice_data,
+        })
         print("Google Sheets успешно инициализирован")
         return {
             "stats": stats_sheet,
@@ -163,125 +838,1495 @@ def init_sheets():
         return None
 
 # Периодическое переподключение к Google Sheets
-def reconnect_sheets():
+def reconnect_sheets(force=False):
     global sheets
-    if not all(sheets.values()):
+    if SHEETS_ENABLED and (force or not all(sheets.values())):
         print("Попытка переподключения к Google Sheets")
         new_sheets = init_sheets()
         if new_sheets:
             sheets = new_sheets
             sync_stats_to_sheets()
             load_users()
+            save_users()
             load_last_choice()
+            flush_last_choice()
+            if SHEETS_PRIMARY and not stats_loaded:
+                load_stats()
+            sheets_prefetched.clear()
             print("Переподключение успешно, данные синхронизированы")
 
-# Загрузка данных из Google Sheets
-def load_users():
-    global users
-    if not sheets["users"]:
-        print("Google Sheets недоступен, использую локальный кэш пользователей")
-        return users
-    try:
-        data = sheets["users"].get_all_values()[1:]
-        users = {}
-        for row in data:
+# Пробный запрос после размыкания цепи: переподключение с перечитыванием
+# листов и сбросом всего, что накопилось локально за время сбоя
+def probe_sheets():
+    if sheets_breaker.state != CircuitBreaker.CLOSED and not sheets_breaker.is_open():
+        reconnect_sheets(force=True)
+
+# Содержимое листа с заголовком. Сразу после подключения берётся из
+# прочитанного batchGet (один раз), потом — обычным get_all_values
+def sheet_values(name):
+    data = sheets_prefetched.pop(name, None)
+    if data is None:
+        data = sheets[name].get_all_values()
+    return data
+
+# Номер первой строки, записанной append_rows (из ответа API "Users!A5:C6")
+def updated_start_row(response):
+    try:
+        match = re.search(r"![A-Z]+(\d+)", response["updates"]["updatedRange"])
+        return int(match.group(1))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+# Разбор листа Users: {chat_id: [user, ...]}, индекс строк и число дублей
+def parse_users_sheet(data):
+    loaded = {}
+    rows = {}
+    duplicates = 0
+    for row_number, row in enumerate(data, start=2):
+        try:
+            chat_id = row[0]
+            user_id = int(row[1])
+            username = row[2]
+            if (chat_id, user_id) in rows:
+                duplicates += 1
+                continue
+            if chat_id not in loaded:
+                loaded[chat_id] = []
+            loaded[chat_id].append({"id": user_id, "name": username})
+            rows[(chat_id, user_id)] = row_number
+        except (IndexError, ValueError) as e:
+            print(f"Ошибка обработки строки пользователей: {row}, ошибка: {e}")
+    return loaded, rows, duplicates
+
+# Загрузка данных из Google Sheets
+def load_users():
+    global users_rows
+    if not sheets["users"]:
+        print("Google Sheets недоступен, использую локальный кэш пользователей")
+        return users_records()
+    try:
+        with users_flush_lock:
+            data = sheet_values("users")[1:]
+            loaded, rows, duplicates = parse_users_sheet(data)
+            with users_sync_lock:
+                # Регистрации, которые ещё не дошли до таблицы, не теряем
+                for (chat_id, user_id), username in users_dirty.items():
+                    chat_users = loaded.setdefault(chat_id, [])
+                    for user in chat_users:
+                        if user["id"] == user_id:
+                            user["name"] = username
+                            break
+                    else:
+                        chat_users.append({"id": user_id, "name": username})
+                # Реплика только обновляет индекс строк, состояние бота не трогает
+                if SHEETS_PRIMARY:
+                    merge_users(loaded)
+                users_rows = rows
+            print("Пользователи загружены из Google Sheets")
+            if duplicates:
+                # Под той же блокировкой: между чтением и перезаписью лист не растёт
+                print(f"В листе Users найдено {duplicates} дублей, выполняю компактизацию")
+                compact_users(loaded, len(data) + 1)
+        return loaded
+    except Exception as e:
+        print(f"Ошибка загрузки пользователей: {e}")
+    return users_records()
+
+# Регистрация или смена имени участника в памяти. True — если что-то изменилось
+def upsert_user(chat_id, user_id, username):
+    with users.lock(chat_id):
+        members = users.get(chat_id)
+        if members is None:
+            members = users[chat_id] = ChatMembers()
+        return members.upsert(user_id, username)
+
+# Слияние загруженного реестра с памятью. Участники не удаляются, поэтому
+# регистрации, сделанные во время загрузки, не теряются; имена берутся из таблицы
+def merge_users(loaded):
+    for chat_id, loaded_users in loaded.items():
+        for user in loaded_users:
+            upsert_user(chat_id, user["id"], user["name"])
+
+def load_last_choice():
+    global last_choice_rows
+    if not sheets["last_choice"]:
+        print("Google Sheets недоступен, использую локальный кэш LastChoice")
+        return dict(last_choice.items()), dict(last_agr.items())
+    try:
+        with last_choice_flush_lock:
+            data = sheet_values("last_choice")[1:]
+            loaded_choice = {}
+            loaded_agr = {}
+            rows = {}
+            for row_number, row in enumerate(data, start=2):
+                try:
+                    chat_id = row[0]
+                    choose_timestamp = float(row[1]) if row[1] else 0
+                    agr_timestamp = float(row[2]) if len(row) > 2 and row[2] else 0
+                    if chat_id and chat_id not in rows:
+                        rows[chat_id] = row_number
+                    if choose_timestamp:
+                        loaded_choice[chat_id] = choose_timestamp
+                    if agr_timestamp:
+                        loaded_agr[chat_id] = agr_timestamp
+                except (IndexError, ValueError):
+                    continue
+            with last_choice_sync_lock:
+                # Время кд только растёт: несохранённые значения не откатываем
+                if SHEETS_PRIMARY:
+                    last_choice.update_max(loaded_choice)
+                    last_agr.update_max(loaded_agr)
+                last_choice_rows = rows
+        print("LastChoice и LastAgr загружены из Google Sheets")
+        return loaded_choice, loaded_agr
+    except Exception as e:
+        print(f"Ошибка загрузки LastChoice/LastAgr: {e}")
+    return dict(last_choice.items()), dict(last_agr.items())
+
+# Агрегаты статистики одного чата: счётчики и отсортированные рейтинги
+class ChatStats:
+    def __init__(self):
+        self.members = {}    # {user_id: {"name": ..., "wins": ..., "losses": ...}}
+        self.by_wins = []    # user_id по убыванию побед
+        self.by_losses = []  # user_id по убыванию поражений
+        self.days = {}       # дневные корзины: {"YYYY-MM-DD": {user_id: [побед, поражений]}}
+        self.latest = ""     # дата последней учтённой строки: "YYYY-MM-DD HH:MM:SS"
+
+    def add(self, user_id, username, status, day=None):
+        member = self.members.get(user_id)
+        if member is None:
+            member = {"name": username, "wins": 0, "losses": 0}
+            self.members[user_id] = member
+            self.by_wins.append(user_id)
+            self.by_losses.append(user_id)
+        if status == "Красавчик":
+            member["wins"] += 1
+            self._bubble_up(self.by_wins, user_id, "wins")
+        elif status == "Пидор":
+            member["losses"] += 1
+            self._bubble_up(self.by_losses, user_id, "losses")
+        if day:
+            counts = self.days.setdefault(day, {}).setdefault(user_id, [0, 0])
+            if status == "Красавчик":
+                counts[0] += 1
+            elif status == "Пидор":
+                counts[1] += 1
+
+    # Счётчик вырос на 1 — участник может только подняться в рейтинге
+    def _bubble_up(self, ranking, user_id, key):
+        i = ranking.index(user_id)
+        value = self.members[user_id][key]
+        while i > 0 and self.members[ranking[i - 1]][key] < value:
+            ranking[i] = ranking[i - 1]
+            i -= 1
+        ranking[i] = user_id
+
+    def leaderboard(self, key="wins"):
+        ranking = self.by_wins if key == "wins" else self.by_losses
+        return [(user_id, self.members[user_id]) for user_id in ranking]
+
+    # Рейтинги за дни с start по end (datetime.date) включительно: сумма
+    # дневных корзин, без просмотра лога. Возвращает копии (by_wins, by_losses)
+    def period(self, start, end):
+        days = (end - start).days + 1
+        if days <= len(self.days):
+            keys = [(start + datetime.timedelta(days=i)).isoformat() for i in range(days)]
+        else:
+            keys = [day for day in self.days if start.isoformat() <= day <= end.isoformat()]
+        totals = {}
+        for day in keys:
+            for user_id, (wins, losses) in self.days.get(day, {}).items():
+                counts = totals.setdefault(user_id, [0, 0])
+                counts[0] += wins
+                counts[1] += losses
+        entries = [
+            (user_id, {"name": member["name"], "wins": totals[user_id][0], "losses": totals[user_id][1]})
+            for user_id, member in self.members.items() if user_id in totals
+        ]
+        by_wins = sorted(entries, key=lambda entry: -entry[1]["wins"])
+        by_losses = sorted(entries, key=lambda entry: -entry[1]["losses"])
+        return by_wins, by_losses
+
+# Строка статистики для Sheet1
+def make_stats_row(date, member, status, chat_id):
+    return [date, str(member.id), "@" + member.name, status, chat_id]
+
+# Учёт строки статистики в агрегатах. Старые строки без Chat ID
+# относим к чатам, где пользователь зарегистрирован
+def apply_stats_row(row, user_chats=None, aggregates=None):
+    try:
+        user_id, username, status = row[1], row[2], row[3]
+    except IndexError:
+        print(f"Ошибка обработки строки статистики: {row}")
+        return
+    # Дата "YYYY-MM-DD HH:MM:SS" -> дневная корзина
+    day = row[0][:10] if re.match(r"\d{4}-\d{2}-\d{2}", row[0]) else None
+    chat_id = row[4] if len(row) > 4 and row[4] else None
+    if chat_id:
+        chat_ids = [chat_id]
+    else:
+        if user_chats is None:
+            user_chats = build_user_chats()
+        chat_ids = user_chats.get(user_id, [])
+    if aggregates is None:
+        aggregates = stats_aggregates
+    for chat_id in chat_ids:
+        with stats_aggregates.lock(chat_id):
+            chat_stats = aggregates.get(chat_id)
+            if chat_stats is None:
+                chat_stats = aggregates[chat_id] = ChatStats()
+            chat_stats.add(user_id, username, status, day)
+            if row[0] > chat_stats.latest:
+                chat_stats.latest = row[0]
+
+# Индекс {user_id: [chat_id, ...]} для строк статистики без Chat ID
+def build_user_chats():
+    user_chats = {}
+    for chat_id, members in users.items():
+        for member in members:
+            user_chats.setdefault(str(member.id), []).append(chat_id)
+    return user_chats
+
+# Построение агрегатов статистики: один полный проход по логу при старте
+def load_stats():
+    global stats_loaded
+    try:
+        data = storage.load_stats_rows()
+        loaded = True
+    except Exception as e:
+        print(f"Ошибка загрузки статистики: {e}, строю по локальному кэшу")
+        data = stats_writer.pending()
+        loaded = False
+    user_chats = build_user_chats()
+    aggregates = {}
+    for row in data:
+        apply_stats_row(row, user_chats, aggregates)
+    stats_aggregates.replace(aggregates)
+    # Агрегаты больше не из снимка: журнал проигрывается в них целиком
+    snapshot_stats_marks.clear()
+    stats_loaded = loaded
+    print(f"Статистика загружена: {len(data)} записей, {len(stats_aggregates)} чатов")
+    return stats_aggregates
+
+# Последние строки Sheet1 — для проверки дублей при проигрывании журнала
+def load_recent_stats_rows():
+    global recent_stats_rows
+    data = sheet_values("stats")[1:]
+    recent_stats_rows = set(tuple(row) for row in data[-JOURNAL_DEDUP_ROWS:])
+    return data
+
+# Отложенный вызов: повторные запросы в пределах delay склеиваются в один
+class DelayedCall:
+    def __init__(self, delay, func):
+        self.delay = delay
+        self.func = func
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def schedule(self):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self._run)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _run(self):
+        with self.lock:
+            self.timer = None
+        self.func()
+
+# Задача планировщика: разовая (at), периодическая (interval, секунд) или
+# ежедневная (daily, "ЧЧ:ММ")
+class Job:
+    def __init__(self, run_at, func, args=(), key=None, interval=None, daily=None):
+        self.run_at = run_at
+        self.func = func
+        self.args = args
+        self.key = key
+        self.interval = interval
+        self.daily = daily
+        self.name = getattr(func, "__name__", "job")
+        self.cancelled = False
+
+    # Время следующего запуска периодической задачи, None — разовая
+    def next_run(self, now):
+        if self.interval:
+            return now + self.interval
+        if self.daily:
+            return next_daily_run(self.daily, now)
+        return None
+
+# Ближайший момент "ЧЧ:ММ" по местному времени после now
+def next_daily_run(at_time, now):
+    hour, minute = (int(part) for part in at_time.split(":"))
+    moment = datetime.datetime.fromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if moment.timestamp() <= now:
+        moment += datetime.timedelta(days=1)
+    return moment.timestamp()
+
+# Планировщик на двоичной куче: поток спит ровно до ближайшей задачи,
+# добавление и извлечение — O(log n). Задачи с ключом (вид, chat_id)
+# можно отменить по ключу или все задачи чата сразу: запись в куче только
+# помечается и выбрасывается при извлечении, а когда отменённых много,
+# куча перестраивается. Сами задачи выполняются в пуле потоков;
+# периодическая задача снова ставится в кучу после завершения
+class Scheduler:
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.cond = threading.Condition()
+        self.heap = []          # [(run_at, порядковый номер, Job)]
+        self.sequence = itertools.count()
+        self.keyed = {}         # {key: Job}
+        self.chat_keys = {}     # {chat_id: {key, ...}}
+        self.cancelled = 0      # отменённых записей, ещё лежащих в куче
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def _push(self, job):
+        heapq.heappush(self.heap, (job.run_at, next(self.sequence), job))
+        if self.heap[0][2] is job:
+            self.cond.notify()
+
+    def _forget(self, job):
+        if job.key is not None and self.keyed.get(job.key) is job:
+            del self.keyed[job.key]
+            chat_keys = self.chat_keys.get(job.key[1])
+            if chat_keys is not None:
+                chat_keys.discard(job.key)
+                if not chat_keys:
+                    del self.chat_keys[job.key[1]]
+
+    # Разовая задача на момент run_at. Задача с тем же ключом заменяется
+    def at(self, run_at, func, *args, key=None):
+        job = Job(run_at, func, args, key=key)
+        with self.cond:
+            if key is not None:
+                self._cancel(key)
+                self.keyed[key] = job
+                self.chat_keys.setdefault(key[1], set()).add(key)
+            self._push(job)
+        return job
+
+    def every(self, seconds, func):
+        job = Job(time.time() + seconds, func, interval=seconds)
+        with self.cond:
+            self._push(job)
+        return job
+
+    def daily(self, at_time, func):
+        job = Job(next_daily_run(at_time, time.time()), func, daily=at_time)
+        with self.cond:
+            self._push(job)
+        return job
+
+    def _cancel(self, key):
+        job = self.keyed.get(key)
+        if job is None:
+            return False
+        self._forget(job)
+        job.cancelled = True
+        self.cancelled += 1
+        if self.cancelled >= SCHEDULER_COMPACT_MIN and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return True
+
+    def cancel(self, key):
+        with self.cond:
+            return self._cancel(key)
+
+    # Отменить все задачи чата (бота удалили из чата)
+    def cancel_chat(self, chat_id):
+        with self.cond:
+            keys = list(self.chat_keys.get(chat_id, ()))
+            for key in keys:
+                self._cancel(key)
+        return len(keys)
+
+    def has(self, key):
+        with self.cond:
+            return key in self.keyed
+
+    def __len__(self):
+        with self.cond:
+            return len(self.heap) - self.cancelled
+
+    # Ближайшая задача, которую пора выполнить; ждёт, пока такая появится
+    def _next_due(self):
+        with self.cond:
+            while True:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay <= 0:
+                    job = heapq.heappop(self.heap)[2]
+                    self._forget(job)
+                    return job
+                self.cond.wait(delay)
+
+    def _execute(self, job):
+        started = time.perf_counter()
+        try:
+            if profiler.active:
+                profiler.run(f"job:{job.name}", job.func, *job.args, counted=False)
+            else:
+                job.func(*job.args)
+        except Exception as e:
+            print(f"Ошибка задачи {job.name}: {e}")
+        finally:
+            metrics.observe("bot_job_duration_seconds", time.perf_counter() - started, (("job", job.name),))
+        next_run = job.next_run(time.time())
+        if next_run is not None:
+            job.run_at = next_run
+            with self.cond:
+                self._push(job)
+
+    def run(self):
+        while True:
+            job = self._next_due()
+            self.pool.submit(self._execute, job)
+
+scheduler = Scheduler()
+
+# Пометить регистрацию или смену имени для записи в Google Sheets
+def mark_user_dirty(chat_id, user_id, username):
+    with journal.lock:
+        journal.write({"op": "user", "chat_id": chat_id, "user_id": user_id, "name": username})
+        with users_sync_lock:
+            users_dirty[(chat_id, user_id)] = username
+
+# Сохранение данных в Google Sheets: дописываем новые регистрации
+# и обновляем изменившиеся имена, не трогая остальные строки
+def save_users():
+    if not sheets_available("users"):
+        print("Google Sheets недоступен, пользователи сохранены в локальном кэше")
+        return
+    with users_flush_lock:
+        with users_sync_lock:
+            dirty = dict(users_dirty)
+            new_keys = []
+            new_rows = []
+            updates = []
+            for (chat_id, user_id), username in dirty.items():
+                row_number = users_rows.get((chat_id, user_id))
+                if row_number:
+                    updates.append({"range": f"C{row_number}", "values": [[username]]})
+                else:
+                    new_keys.append((chat_id, user_id))
+                    new_rows.append([chat_id, str(user_id), username])
+        if not dirty:
+            return
+        try:
+            if updates:
+                sheets["users"].batch_update(updates)
+            start_row = None
+            if new_rows:
+                start_row = updated_start_row(sheets["users"].append_rows(new_rows))
+            with users_sync_lock:
+                if start_row:
+                    for i, key in enumerate(new_keys):
+                        users_rows[key] = start_row + i
+                for key, username in dirty.items():
+                    if users_dirty.get(key) == username:
+                        del users_dirty[key]
+        except Exception as e:
+            print(f"Ошибка сохранения пользователей: {e}")
+            return
+    print(f"Пользователи сохранены в Google Sheets: новых {len(new_rows)}, обновлено {len(updates)}")
+    if new_rows and not start_row:
+        # Не удалось определить номера строк — перечитываем лист
+        load_users()
+    release_journal()
+
+# Полная перезапись листа Users (компактизация дублей и мусора) реестром
+# loaded — содержимым листа без дублей плюс несохранённые регистрации.
+# Не из памяти бота: если лист — реплика, users при импорте ещё пуст.
+# Пишем поверх старых строк и очищаем хвост до last_row — последней строки
+# только что прочитанного листа (row_count после дописываний устаревает),
+# лист не бывает пустым
+def compact_users(loaded, last_row):
+    if not sheets["users"]:
+        return
+    try:
+        with users_flush_lock:
+            with users_sync_lock:
+                dirty = dict(users_dirty)
+                rows = []
+                keys = []
+                for chat_id, chat_users in loaded.items():
+                    for user in chat_users:
+                        rows.append([chat_id, str(user["id"]), user["name"]])
+                        keys.append((chat_id, user["id"]))
+            old_last_row = max(last_row, len(rows) + 1)
+            if rows:
+                sheets["users"].update(values=rows, range_name=f"A2:C{len(rows) + 1}")
+            if old_last_row > len(rows) + 1:
+                sheets["users"].batch_clear([f"A{len(rows) + 2}:C{old_last_row}"])
+            with users_sync_lock:
+                users_rows.clear()
+                for row_number, key in enumerate(keys, start=2):
+                    users_rows[key] = row_number
+                for key, username in dirty.items():
+                    if users_dirty.get(key) == username:
+                        del users_dirty[key]
+        print(f"Лист Users перезаписан: {len(rows)} строк")
+    except Exception as e:
+        print(f"Ошибка компактизации пользователей: {e}")
+
+# Отметить кд чата как изменённый. Запись откладывается на
+# LAST_CHOICE_SAVE_DELAY, чтобы несколько обновлений ушли одним запросом
+def save_last_choice(chat_id=None):
+    with journal.lock, last_choice_sync_lock:
+        if chat_id is not None:
+            journal.write({
+                "op": "cooldown",
+                "chat_id": chat_id,
+                "choose": last_choice.get(chat_id),
+                "agr": last_agr.get(chat_id),
+            })
+            last_choice_dirty.add(chat_id)
+    last_choice_saver.schedule()
+
+# Запись изменённых кд: существующие строки — одним batch_update,
+# новые чаты — одним append_rows
+def flush_last_choice():
+    with last_choice_flush_lock:
+        with last_choice_sync_lock:
+            if not sheets_available("last_choice"):
+                print("Google Sheets недоступен, LastChoice/LastAgr сохранены в локальном кэше")
+                return
+            if not last_choice_dirty:
+                return
+            dirty = set(last_choice_dirty)
+            last_choice_dirty.clear()
+            updates = []
+            new_chats = []
+            new_rows = []
+            for chat_id in dirty:
+                choose_time = str(last_choice.get(chat_id, ""))
+                agr_time = str(last_agr.get(chat_id, ""))
+                row_number = last_choice_rows.get(chat_id)
+                if row_number:
+                    updates.append({"range": f"B{row_number}:C{row_number}", "values": [[choose_time, agr_time]]})
+                else:
+                    new_chats.append(chat_id)
+                    new_rows.append([chat_id, choose_time, agr_time])
+        try:
+            if updates:
+                sheets["last_choice"].batch_update(updates)
+            start_row = None
+            if new_rows:
+                start_row = updated_start_row(sheets["last_choice"].append_rows(new_rows))
+                if start_row:
+                    with last_choice_sync_lock:
+                        for i, chat_id in enumerate(new_chats):
+                            last_choice_rows[chat_id] = start_row + i
+            print(f"LastChoice и LastAgr сохранены в Google Sheets: обновлено {len(updates)}, новых {len(new_rows)}")
+        except Exception as e:
+            print(f"Ошибка сохранения LastChoice/LastAgr: {e}")
+            save_last_choice_many(dirty)
+            return
+    if new_rows and not start_row:
+        # Не удалось определить номера строк — перечитываем лист
+        load_last_choice()
+    release_journal()
+
+# Вернуть чаты в очередь записи (после ошибки)
+def save_last_choice_many(chat_ids):
+    with last_choice_sync_lock:
+        last_choice_dirty.update(chat_ids)
+    save_last_choice()
+
+# Локальный журнал изменений, ещё не подтверждённых Google Sheets.
+# Каждая запись — строка JSON; fsync выполняется пачками раз в
+# JOURNAL_FSYNC_INTERVAL. При старте журнал проигрывается в память,
+# а когда все очереди записи пусты — обрезается
+class Journal:
+    def __init__(self, path, fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()
+        self.file = open(path, "a", encoding="utf-8")
+        self.unsynced = False
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.unsynced = True
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def read(self):
+        entries = []
+        with self.lock, open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Недописанная строка при аварийной остановке
+                    print(f"Пропущена повреждённая запись журнала: {line[:100]!r}")
+        return entries
+
+    def truncate(self):
+        with self.lock:
+            self.file.truncate(0)
+            self.file.seek(0)
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+
+    def run(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Ошибка fsync журнала: {e}")
+
+journal = Journal(JOURNAL_PATH) if SHEETS_ENABLED else None
+
+# Есть ли изменения, ещё не записанные в Google Sheets
+def has_pending_writes():
+    # Пока журнал не проигран, его записи ещё не попали в очереди
+    if not sheets_loaded.is_set():
+        return True
+    with stats_writer.lock:
+        if stats_cache:
+            return True
+    with users_sync_lock:
+        if users_dirty:
+            return True
+    with last_choice_sync_lock:
+        if last_choice_dirty:
+            return True
+    return last_choice_flush_lock.locked()
+
+# Обрезать журнал, если всё подтверждено таблицей
+def release_journal():
+    with journal.lock:
+        if not has_pending_writes():
+            journal.truncate()
+
+# Восстановление неподтверждённых изменений из журнала после перезапуска.
+# Вызывается после загрузки данных и построения агрегатов. Если Google Sheets —
+# реплика, состояние уже есть в основном хранилище, журнал лишь заполняет очереди
+def replay_journal(entries=None):
+    if entries is None:
+        entries = journal.read()
+    if not entries:
+        return
+    stats_rows = []
+    for entry in entries:
+        op = entry.get("op")
+        if op == "stats":
+            stats_rows.extend(entry["rows"])
+        elif op == "user":
+            chat_id, user_id, username = entry["chat_id"], entry["user_id"], entry["name"]
+            upsert_user(chat_id, user_id, username)
+            users_dirty[(chat_id, user_id)] = username
+        elif op == "cooldown":
+            chat_id = entry["chat_id"]
+            if entry.get("choose"):
+                last_choice.update_max({chat_id: entry["choose"]})
+            if entry.get("agr"):
+                last_agr.update_max({chat_id: entry["agr"]})
+            last_choice_dirty.add(chat_id)
+    # Строки, которые успели попасть в таблицу до обрезки журнала, не дублируем
+    stats_rows = [row for row in stats_rows if tuple(row) not in recent_stats_rows]
+    if SHEETS_PRIMARY:
+        # Если агрегаты взяты из снимка, строки не новее его отметки чата в
+        # них уже есть (/choose в чате — не чаще раза в сутки). Отбираем до
+        # применения: строки одной пары имеют одну дату
+        fresh = [row for row in stats_rows if not snapshot_covers(row)]
+        for row in fresh:
+            apply_stats_row(row)
+    with stats_writer.lock:
+        stats_cache.extend(stats_rows)
+    print(f"Журнал проигран: {len(entries)} записей, {len(stats_rows)} строк статистики ожидают записи")
+
+# Строка уже учтена в агрегатах, восстановленных из снимка
+def snapshot_covers(row):
+    chat_id = row[4] if len(row) > 4 and row[4] else None
+    return chat_id in snapshot_stats_marks and row[0] <= snapshot_stats_marks[chat_id]
+
+# Фоновая запись статистики в Google Sheets (write-behind).
+# Обработчики только кладут строки в stats_cache, поток пишет их пачками
+# одним append_rows, сохраняя порядок и выжидая при ошибках квоты
+class StatsWriter:
+    def __init__(self, interval=STATS_FLUSH_INTERVAL, batch_size=STATS_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()        # защищает stats_cache
+        self.flush_lock = threading.Lock()  # одновременно пишет только один сброс
+        self.wakeup = threading.Event()
+        self.backoff = 0
+
+    def enqueue(self, rows):
+        with journal.lock, self.lock:
+            journal.write({"op": "stats", "rows": rows})
+            stats_cache.extend(rows)
+            size = len(stats_cache)
+        if size >= self.batch_size:
+            self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return list(stats_cache)
+
+    # Один сброс очереди. Строки удаляются из кэша только после успешной записи
+    def flush(self):
+        with self.flush_lock:
+            if not sheets_available("stats"):
+                return 0
+            with self.lock:
+                batch = list(stats_cache)
+            if not batch:
+                return 0
+            sheets["stats"].append_rows(batch)
+            with self.lock:
+                del stats_cache[:len(batch)]
+            # Лист, прочитанный при подключении, этих строк уже не содержит
+            sheets_prefetched.pop("stats", None)
+            return len(batch)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.backoff or self.interval)
+            self.wakeup.clear()
+            try:
+                written = self.flush()
+                if written:
+                    print(f"Записано {written} строк статистики в Google Sheets")
+                    release_journal()
+                self.backoff = 0
+            except Exception as e:
+                self.backoff = min(max(self.backoff * 2, self.interval), STATS_MAX_BACKOFF)
+                if getattr(e, "code", None) == 429:
+                    print(f"Превышена квота Google Sheets, повтор через {self.backoff} сек.")
+                else:
+                    print(f"Ошибка записи статистики: {e}, повтор через {self.backoff} сек.")
+
+stats_writer = StatsWriter()
+
+# Синхронизация локального кэша статистики с Google Sheets
+def sync_stats_to_sheets():
+    try:
+        written = stats_writer.flush()
+        if written:
+            print(f"Синхронизировано {written} записей статистики в Google Sheets")
+            release_journal()
+    except Exception as e:
+        print(f"Ошибка синхронизации статистики: {e}")
+
+# Хранилище состояния бота. Обработчики работают с данными в памяти
+# (users, last_choice, last_agr, агрегаты), а хранилище отвечает за
+# начальную загрузку и запись изменений. Хранилище без какого-либо из
+# абстрактных методов не создаётся (TypeError при запуске, а не посреди команды)
+class Storage(ABC):
+    name = "storage"
+
+    @abstractmethod
+    def load_users(self):
+        pass
+
+    @abstractmethod
+    def save_user(self, chat_id, user_id, username):
+        pass
+
+    @abstractmethod
+    def load_cooldowns(self):
+        pass
+
+    @abstractmethod
+    def save_cooldown(self, chat_id, choose_time, agr_time):
+        pass
+
+    @abstractmethod
+    def append_stats(self, rows):
+        pass
+
+    @abstractmethod
+    def load_stats_rows(self):
+        pass
+
+    def is_empty(self):
+        return False
+
+    def flush(self):
+        pass
+
+# Google Sheets: запись через очереди, журнал и отложенные сбросы
+class SheetsStorage(Storage):
+    name = "sheets"
+
+    def load_users(self):
+        return load_users()
+
+    def save_user(self, chat_id, user_id, username):
+        mark_user_dirty(chat_id, user_id, username)
+        users_saver.schedule()
+
+    def load_cooldowns(self):
+        return load_last_choice()
+
+    def save_cooldown(self, chat_id, choose_time, agr_time):
+        save_last_choice(chat_id)
+
+    def append_stats(self, rows):
+        stats_writer.enqueue(rows)
+
+    def load_stats_rows(self):
+        if not sheets["stats"]:
+            raise RuntimeError("Google Sheets недоступен")
+        return load_recent_stats_rows() + stats_writer.pending()
+
+    def flush(self):
+        sync_stats_to_sheets()
+        save_users()
+        flush_last_choice()
+        journal.sync()
+
+# Локальная база SQLite: все чтения и записи идут в файл на диске
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                chat_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS users_user_id ON users (user_id);
+            CREATE TABLE IF NOT EXISTS cooldowns (
+                chat_id TEXT PRIMARY KEY,
+                choose_time REAL,
+                agr_time REAL
+            );
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT,
+                user_id TEXT,
+                username TEXT,
+                status TEXT,
+                chat_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS stats_chat_user ON stats (chat_id, user_id);
+        """)
+        self.db.commit()
+
+    def load_users(self):
+        loaded = {}
+        with self.lock:
+            for chat_id, user_id, username in self.db.execute(
+                "SELECT chat_id, user_id, username FROM users ORDER BY rowid"
+            ):
+                loaded.setdefault(chat_id, []).append({"id": user_id, "name": username})
+        print("Пользователи загружены из SQLite")
+        return loaded
+
+    def save_user(self, chat_id, user_id, username):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO users (chat_id, user_id, username) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET username = excluded.username",
+                (chat_id, user_id, username),
+            )
+
+    def load_cooldowns(self):
+        loaded_choice = {}
+        loaded_agr = {}
+        with self.lock:
+            for chat_id, choose_time, agr_time in self.db.execute(
+                "SELECT chat_id, choose_time, agr_time FROM cooldowns"
+            ):
+                if choose_time:
+                    loaded_choice[chat_id] = choose_time
+                if agr_time:
+                    loaded_agr[chat_id] = agr_time
+        print("LastChoice и LastAgr загружены из SQLite")
+        return loaded_choice, loaded_agr
+
+    def save_cooldown(self, chat_id, choose_time, agr_time):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO cooldowns (chat_id, choose_time, agr_time) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET "
+                "choose_time = excluded.choose_time, agr_time = excluded.agr_time",
+                (chat_id, choose_time, agr_time),
+            )
+
+    def append_stats(self, rows):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO stats (date, user_id, username, status, chat_id) VALUES (?, ?, ?, ?, ?)",
+                [(row + [""] * 5)[:5] for row in rows],
+            )
+
+    def load_stats_rows(self):
+        with self.lock:
+            return [
+                list(row) for row in self.db.execute(
+                    "SELECT date, user_id, username, status, chat_id FROM stats ORDER BY id"
+                )
+            ]
+
+    def is_empty(self):
+        with self.lock:
+            return not any(
+                self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                for table in ("users", "cooldowns", "stats")
+            )
+
+    # Первичное наполнение базы из другого хранилища (переезд с Google Sheets)
+    def import_from(self, other):
+        loaded_users = other.load_users()
+        loaded_choice, loaded_agr = other.load_cooldowns()
+        rows = other.load_stats_rows()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO users (chat_id, user_id, username) VALUES (?, ?, ?)",
+                [(chat_id, user["id"], user["name"]) for chat_id, user_list in loaded_users.items() for user in user_list],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cooldowns (chat_id, choose_time, agr_time) VALUES (?, ?, ?)",
+                [(chat_id, loaded_choice.get(chat_id), loaded_agr.get(chat_id))
+                 for chat_id in set(loaded_choice) | set(loaded_agr)],
+            )
+            self.db.executemany(
+                "INSERT INTO stats (date, user_id, username, status, chat_id) VALUES (?, ?, ?, ?, ?)",
+                [(row + [""] * 5)[:5] for row in rows],
+            )
+        print(f"SQLite заполнен из {other.name}: {len(rows)} строк статистики")
+
+# Основное хранилище + асинхронная реплика. Ошибки реплики не мешают работе
+class ReplicatedStorage(Storage):
+    def __init__(self, primary, replica):
+        self.primary = primary
+        self.replica = replica
+        self.name = f"{primary.name}+{replica.name}"
+
+    def _replicate(self, method, *args):
+        try:
+            getattr(self.replica, method)(*args)
+        except Exception as e:
+            print(f"Ошибка записи в реплику {self.replica.name}: {e}")
+
+    def load_users(self):
+        return self.primary.load_users()
+
+    def save_user(self, chat_id, user_id, username):
+        self.primary.save_user(chat_id, user_id, username)
+        self._replicate("save_user", chat_id, user_id, username)
+
+    def load_cooldowns(self):
+        return self.primary.load_cooldowns()
+
+    def save_cooldown(self, chat_id, choose_time, agr_time):
+        self.primary.save_cooldown(chat_id, choose_time, agr_time)
+        self._replicate("save_cooldown", chat_id, choose_time, agr_time)
+
+    def append_stats(self, rows):
+        self.primary.append_stats(rows)
+        self._replicate("append_stats", rows)
+
+    def load_stats_rows(self):
+        return self.primary.load_stats_rows()
+
+    def is_empty(self):
+        return self.primary.is_empty()
+
+    def flush(self):
+        self.primary.flush()
+        self.replica.flush()
+
+# Изменение из ленты другой реплики — в память этой реплики
+def apply_change(entry):
+    op = entry.get("op")
+    if op == "user":
+        new_chat = entry["chat_id"] not in users
+        upsert_user(entry["chat_id"], entry["user_id"], entry["name"])
+        if new_chat:
+            schedule_chat_meme(entry["chat_id"])
+    elif op == "cooldown":
+        chat_id = entry["chat_id"]
+        if entry.get("choose"):
+            last_choice.update_max({chat_id: entry["choose"]})
+        if entry.get("agr"):
+            last_agr.update_max({chat_id: entry["agr"]})
+    elif op == "stats":
+        for row in entry["rows"]:
+            apply_stats_row(row)
+
+# Изменение из ленты — в хранилище (у лидера это Google Sheets)
+def write_change(target, entry):
+    op = entry.get("op")
+    if op == "user":
+        target.save_user(entry["chat_id"], entry["user_id"], entry["name"])
+    elif op == "cooldown":
+        target.save_cooldown(entry["chat_id"], entry.get("choose"), entry.get("agr"))
+    elif op == "stats":
+        target.append_stats(entry["rows"])
+
+# Координатор реплик на общей базе SQLite. Один экземпляр держит аренду
+# лидерства и выполняет задачи планировщика; изменения каждой реплики
+# пишутся в ленту, остальные раз в REPLICA_SYNC_INTERVAL применяют их к
+# памяти. Кд команд проверяются и записываются в базе одной транзакцией,
+# поэтому действуют на все реплики сразу
+class ReplicaCoordinator:
+    LEASE = "scheduler"
+
+    def __init__(self, path, replica_id=REPLICA_ID):
+        self.replica_id = replica_id
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=LEADER_LEASE, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS replica_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replica_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                replica TEXT NOT NULL,
+                entry TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replica_cooldowns (
+                name TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (name, chat_id)
+            );
+            CREATE TABLE IF NOT EXISTS replica_agreements (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replica_cursors (
+                name TEXT PRIMARY KEY,
+                position INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replica_updates (
+                update_id INTEGER PRIMARY KEY,
+                expires_at REAL NOT NULL
+            );
+        """)
+        # Всё, что уже в ленте, есть и в общей базе, которую реплика сейчас загрузит
+        self.position = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM replica_changes").fetchone()[0]
+        self.db.execute("INSERT OR IGNORE INTO replica_cursors (name, position) VALUES ('sheets', ?)", (self.position,))
+        self.holder = None
+        self.leader_until = 0
+        self.forwarding = False  # лидер пишет ленту в Google Sheets
+
+    # Транзакция с немедленной блокировкой записи: реплики выполняют её по очереди
+    def _transaction(self, func):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def is_leader(self):
+        return time.time() < self.leader_until
+
+    # Взять или продлить аренду: удаётся, если она наша или истекла
+    def renew_lease(self):
+        now = time.time()
+
+        def renew():
+            self.db.execute(
+                "INSERT INTO replica_leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE replica_leases.holder = excluded.holder OR replica_leases.expires_at < ?",
+                (self.LEASE, self.replica_id, now + LEADER_LEASE, now),
+            )
+            return self.db.execute("SELECT holder FROM replica_leases WHERE name = ?", (self.LEASE,)).fetchone()[0]
+
+        was_leader = self.is_leader()
+        self.holder = self._transaction(renew)
+        if self.holder == self.replica_id:
+            # Локально аренда кончается раньше, чем в базе: пока она действует,
+            # другая реплика её перехватить не может
+            self.leader_until = now + LEADER_LEASE - LEADER_RENEW_INTERVAL
+        else:
+            self.leader_until = 0
+        if self.is_leader() and not was_leader:
+            print(f"Реплика {self.replica_id} стала лидером")
+            if sheets_storage:
+                threading.Thread(target=self._take_over_sheets, daemon=True).start()
+        elif was_leader and not self.is_leader():
+            print(f"Реплика {self.replica_id} больше не лидер (лидер: {self.holder})")
+            self.forwarding = False
+
+    # Новый лидер перечитывает листы (номера строк могли устареть), затем
+    # продолжает запись ленты в Google Sheets с сохранённой позиции
+    def _take_over_sheets(self):
+        sheets_loaded.wait()
+        reconnect_sheets(force=True)
+        self.forwarding = self.is_leader()
+
+    # Отдать аренду при остановке, чтобы другая реплика не ждала её истечения
+    def release(self):
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM replica_leases WHERE name = ? AND holder = ?", (self.LEASE, self.replica_id)
+            )
+        self.leader_until = 0
+
+    def publish(self, entry):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO replica_changes (replica, entry, created) VALUES (?, ?, ?)",
+                (self.replica_id, json.dumps(entry, ensure_ascii=False), time.time()),
+            )
+
+    # Прочитать новые записи ленты: чужие применяются к памяти, у лидера
+    # все записи затем уходят в Google Sheets
+    def sync(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, replica, entry FROM replica_changes WHERE id > ? ORDER BY id LIMIT ?",
+                (self.position, REPLICA_SYNC_BATCH),
+            ).fetchall()
+        for change_id, replica, entry in rows:
+            if replica != self.replica_id:
+                apply_change(json.loads(entry))
+            self.position = change_id
+        if self.forwarding:
+            self.forward()
+        return len(rows)
+
+    # Позиция в ленте хранится в базе: новый лидер продолжит с того же места
+    def forward(self):
+        with self.lock:
+            start = self.db.execute("SELECT position FROM replica_cursors WHERE name = 'sheets'").fetchone()[0]
+            rows = self.db.execute(
+                "SELECT id, entry FROM replica_changes WHERE id > ? AND id <= ? ORDER BY id",
+                (start, self.position),
+            ).fetchall()
+        for change_id, entry in rows:
+            write_change(sheets_storage, json.loads(entry))
+        if rows:
+            with self.lock:
+                self.db.execute("UPDATE replica_cursors SET position = ? WHERE name = 'sheets'", (rows[-1][0],))
+
+    # Удалить старые записи ленты (кроме ещё не записанных в Google Sheets)
+    # и договорённости
+    def cleanup(self):
+        expired = time.time() - REPLICA_CHANGES_TTL
+        with self.lock:
+            position = self.position
+            if sheets_storage:
+                position = min(position, self.db.execute(
+                    "SELECT position FROM replica_cursors WHERE name = 'sheets'"
+                ).fetchone()[0])
+            self.db.execute("DELETE FROM replica_changes WHERE created < ? AND id <= ?", (expired, position))
+            self.db.execute("DELETE FROM replica_agreements WHERE created < ?", (expired - 24 * 3600,))
+            self.db.execute("DELETE FROM replica_updates WHERE expires_at < ?", (time.time(),))
+
+    # Кд команды для всех реплик: прочитать, проверить политикой и записать
+    # в одной транзакции. Локальное значение учитывается, если в базе его ещё нет
+    def hit_cooldown(self, policy, chat_id, local_state, now):
+        def claim():
+            row = self.db.execute(
+                "SELECT used_at FROM replica_cooldowns WHERE name = ? AND chat_id = ?", (policy.name, chat_id)
+            ).fetchone()
+            state = max(row[0] if row else 0, local_state or 0) or None
+            state, retry_after = policy.hit(state, now)
+            if not retry_after:
+                self.db.execute(
+                    "INSERT INTO replica_cooldowns (name, chat_id, used_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name, chat_id) DO UPDATE SET used_at = excluded.used_at",
+                    (policy.name, chat_id, state),
+                )
+            return state, retry_after
+
+        return self._transaction(claim)
+
+    # Отметить update_id для всех реплик. False — обновление уже приняла
+    # эта или другая реплика, и отметка ещё не истекла
+    def claim_update(self, update_id, now, ttl):
+        def claim():
+            row = self.db.execute("SELECT expires_at FROM replica_updates WHERE update_id = ?", (update_id,)).fetchone()
+            if row and row[0] > now:
+                return False
+            self.db.execute(
+                "INSERT INTO replica_updates (update_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT (update_id) DO UPDATE SET expires_at = excluded.expires_at",
+                (update_id, now + ttl),
+            )
+            return True
+
+        return self._transaction(claim)
+
+    # Обновление не принято: его повторную доставку примет любая реплика
+    def forget_update(self, update_id):
+        with self.lock:
+            self.db.execute("DELETE FROM replica_updates WHERE update_id = ?", (update_id,))
+
+    # Общее значение по ключу: первая реплика записывает своё, остальные получают его
+    def agree(self, key, value):
+        def agree():
+            self.db.execute(
+                "INSERT OR IGNORE INTO replica_agreements (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            return self.db.execute("SELECT value FROM replica_agreements WHERE key = ?", (key,)).fetchone()[0]
+
+        return self._transaction(agree)
+
+    # Дождаться значения по ключу, которое запишет другая реплика. None — не дождались
+    def wait_agreement(self, key, timeout, interval=REPLICA_SYNC_INTERVAL):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                row = self.db.execute("SELECT value FROM replica_agreements WHERE key = ?", (key,)).fetchone()
+            if row or time.monotonic() >= deadline:
+                return row[0] if row else None
+            time.sleep(interval)
+
+    def metrics(self):
+        return {
+            "replica_id": self.replica_id,
+            "leader": self.is_leader(),
+            "holder": self.holder,
+            "position": self.position,
+        }
+
+    def run(self):
+        last_renew = 0
+        while True:
             try:
-                chat_id = row[0]
-                user_id = int(row[1])
-                username = row[2]
-                if chat_id not in users:
-                    users[chat_id] = []
-                users[chat_id].append({"id": user_id, "name": username})
-            except (IndexError, ValueError) as e:
-                print(f"Ошибка обработки строки пользователей: {row}, ошибка: {e}")
-        print("Пользователи загружены из Google Sheets")
-    except Exception as e:
-        print(f"Ошибка загрузки пользователей: {e}")
-    return users
+                if time.monotonic() - last_renew >= LEADER_RENEW_INTERVAL:
+                    last_renew = time.monotonic()
+                    self.renew_lease()
+                    if self.is_leader():
+                        self.cleanup()
+                self.sync()
+            except Exception as e:
+                print(f"Ошибка синхронизации реплик: {e}")
+            time.sleep(REPLICA_SYNC_INTERVAL)
 
-def load_last_choice():
-    global last_choice, last_agr
-    if not sheets["last_choice"]:
-        print("Google Sheets недоступен, использую локальный кэш LastChoice")
-        return last_choice, last_agr
-    try:
-        data = sheets["last_choice"].get_all_values()[1:]
-        last_choice = {}
-        last_agr = {}
-        for row in data:
-            try:
-                chat_id = row[0]
-                choose_timestamp = float(row[1]) if row[1] else 0
-                agr_timestamp = float(row[2]) if len(row) > 2 and row[2] else 0
-                if choose_timestamp:
-                    last_choice[chat_id] = choose_timestamp
-                if agr_timestamp:
-                    last_agr[chat_id] = agr_timestamp
-            except (IndexError, ValueError):
-                continue
-        print("LastChoice и LastAgr загружены из Google Sheets")
-    except Exception as e:
-        print(f"Ошибка загрузки LastChoice/LastAgr: {e}")
-    return last_choice, last_agr
+# Хранилище реплики: запись в общую базу и в ленту изменений, откуда её
+# подхватывают остальные реплики (а лидер — пишет в Google Sheets)
+class SharedStorage(Storage):
+    def __init__(self, primary, coordinator):
+        self.primary = primary
+        self.coordinator = coordinator
+        self.name = f"{primary.name}, реплика {coordinator.replica_id}"
 
-# Сохранение данных в Google Sheets
-def save_users():
-    if not sheets["users"]:
-        print("Google Sheets недоступен, пользователи сохранены в локальном кэше")
-        return
-    try:
-        sheets["users"].delete_rows(2, sheets["users"].row_count)
-        rows = []
-        for chat_id, user_list in users.items():
-            for user in user_list:
-                rows.append([chat_id, str(user["id"]), user["name"]])
-        if rows:
-            sheets["users"].append_rows(rows)
-        print("Пользователи сохранены в Google Sheets")
-    except Exception as e:
-        print(f"Ошибка сохранения пользователей: {e}")
+    def load_users(self):
+        return self.primary.load_users()
 
-def save_last_choice():
-    if not sheets["last_choice"]:
-        print("Google Sheets недоступен, LastChoice/LastAgr сохранены в локальном кэше")
-        return
+    def save_user(self, chat_id, user_id, username):
+        self.primary.save_user(chat_id, user_id, username)
+        self.coordinator.publish({"op": "user", "chat_id": chat_id, "user_id": user_id, "name": username})
+
+    def load_cooldowns(self):
+        return self.primary.load_cooldowns()
+
+    def save_cooldown(self, chat_id, choose_time, agr_time):
+        self.primary.save_cooldown(chat_id, choose_time, agr_time)
+        self.coordinator.publish({"op": "cooldown", "chat_id": chat_id, "choose": choose_time, "agr": agr_time})
+
+    def append_stats(self, rows):
+        self.primary.append_stats(rows)
+        self.coordinator.publish({"op": "stats", "rows": rows})
+
+    def load_stats_rows(self):
+        return self.primary.load_stats_rows()
+
+    def is_empty(self):
+        return self.primary.is_empty()
+
+    def flush(self):
+        self.primary.flush()
+        if sheets_storage:
+            sheets_storage.flush()
+
+# Задача планировщика, которую при нескольких репликах выполняет только лидер
+def leader_only(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if replicas and not replicas.is_leader():
+            return None
+        return func(*args, **kwargs)
+    return wrapper
+
+users_saver = DelayedCall(USERS_SAVE_DELAY, save_users)
+last_choice_saver = DelayedCall(LAST_CHOICE_SAVE_DELAY, flush_last_choice)
+
+# Снимок состояния на диске: при следующем запуске бот сразу отвечает по
+# нему, а данные из Google Sheets догружаются в фоне
+def save_snapshot():
+    if not (stats_loaded or snapshot_loaded):
+        return  # нечего сохранять: данные ещё не загружены
+    stats = {}
+    for chat_id, chat_stats in stats_aggregates.items():
+        with stats_aggregates.lock(chat_id):
+            stats[chat_id] = {
+                "members": {user_id: dict(member) for user_id, member in chat_stats.members.items()},
+                "by_wins": list(chat_stats.by_wins),
+                "by_losses": list(chat_stats.by_losses),
+                "days": {day: {user_id: list(counts) for user_id, counts in bucket.items()}
+                         for day, bucket in chat_stats.days.items()},
+                "latest": chat_stats.latest,
+            }
+    data = {
+        "time": time.time(),
+        "users": users_records(),
+        "last_choice": dict(last_choice.items()),
+        "last_agr": dict(last_agr.items()),
+        "stats": stats,
+    }
     try:
-        sheets["last_choice"].delete_rows(2, sheets["last_choice"].row_count)
-        rows = []
-        for chat_id in set(list(last_choice.keys()) + list(last_agr.keys())):
-            choose_time = str(last_choice.get(chat_id, ""))
-            agr_time = str(last_agr.get(chat_id, ""))
-            rows.append([chat_id, choose_time, agr_time])
-        if rows:
-            sheets["last_choice"].append_rows(rows)
-        print("LastChoice и LastAgr сохранены в Google Sheets")
+        tmp_path = SNAPSHOT_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, SNAPSHOT_PATH)
     except Exception as e:
-        print(f"Ошибка сохранения LastChoice/LastAgr: {e}")
+        print(f"Ошибка сохранения снимка: {e}")
 
-# Синхронизация локального кэша статистики с Google Sheets
-def sync_stats_to_sheets():
-    global stats_cache
-    if not sheets["stats"] or not stats_cache:
-        return
+def load_snapshot():
+    global snapshot_loaded
     try:
-        for entry in stats_cache:
-            sheets["stats"].append_row(entry)
-        print(f"Синхронизировано {len(stats_cache)} записей статистики в Google Sheets")
-        stats_cache = []
+        with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        aggregates = {}
+        for chat_id, saved in data["stats"].items():
+            chat_stats = aggregates[chat_id] = ChatStats()
+            chat_stats.members = saved["members"]
+            chat_stats.by_wins = saved["by_wins"]
+            chat_stats.by_losses = saved["by_losses"]
+            chat_stats.days = saved.get("days", {})
+            chat_stats.latest = saved.get("latest", "")
+        users.replace(members_from_records(data["users"]))
+        last_choice.replace(data["last_choice"])
+        last_agr.replace(data["last_agr"])
+        stats_aggregates.replace(aggregates)
+        snapshot_stats_marks.clear()
+        snapshot_stats_marks.update({chat_id: chat_stats.latest for chat_id, chat_stats in aggregates.items()})
+    except FileNotFoundError:
+        return False
     except Exception as e:
-        print(f"Ошибка синхронизации статистики: {e}")
+        print(f"Ошибка загрузки снимка: {e}")
+        return False
+    snapshot_loaded = True
+    age = int(time.time() - data.get("time", time.time()))
+    print(f"Состояние восстановлено из снимка ({age} сек. назад): {len(users)} чатов")
+    return True
 
-# Инициализация Google Sheets
-sheets = init_sheets()
-if not sheets:
-    print("Предупреждение: Google Sheets недоступен, бот будет работать с локальным кэшем")
-    sheets = {"stats": None, "users": None, "last_choice": None}
+# Подключение к Google Sheets и загрузка данных: листы, журнал, фоновые
+# потоки записи. Если бот уже отвечает по локальным данным (снимок или
+# SQLite), выполняется в отдельном потоке
+def start_sheets(journal_entries):
+    global sheets
+    started = time.time()
+    sheets = init_sheets()
+    if not sheets:
+        print("Предупреждение: Google Sheets недоступен, бот будет работать с локальным кэшем")
+        sheets = {"stats": None, "users": None, "last_choice": None}
+    if SHEETS_PRIMARY:
+        load_users()
+        load_last_choice()
+        # Без таблицы агрегаты из снимка лучше пустых; их пересчитает переподключение
+        if sheets["stats"] or not snapshot_loaded:
+            load_stats()
+    elif sheets["users"]:
+        importer = None
+        if local_storage.is_empty():
+            importer = replicas.agree("sheets_import", REPLICA_ID) if replicas else REPLICA_ID
+        if importer == REPLICA_ID:
+            # Индексы строк и хвост Sheet1 для реплики строятся при импорте.
+            # Из нескольких одновременно запущенных реплик импортирует одна
+            local_storage.import_from(sheets_storage)
+            if replicas:
+                replicas.agree("sheets_import_done", REPLICA_ID)
+        else:
+            # Остальные читают общую базу только после импорта: в ленту
+            # изменений он не попадает
+            if importer and not replicas.wait_agreement("sheets_import_done", REPLICA_IMPORT_WAIT):
+                print(f"Импорт Google Sheets репликой {importer} не завершился за {REPLICA_IMPORT_WAIT} сек.")
+            # Реплике нужны индексы строк и хвост Sheet1 для проверки дублей
+            load_users()
+            load_last_choice()
+            load_recent_stats_rows()
+    sheets_prefetched.clear()
+    replay_journal(journal_entries)
+    sheets_loaded.set()
+    save_users()
+    save_last_choice()
+
+    # Фоновое переподключение к Google Sheets и заблаговременное обновление токена
+    scheduler.every(5 * 60, leader_only(reconnect_sheets))
+    scheduler.every(60, google_clients.refresh)
+    scheduler.every(SHEETS_BREAKER_OPEN_TIME, leader_only(probe_sheets))
+
+    # Фоновая запись статистики
+    threading.Thread(target=stats_writer.run, daemon=True).start()
+    print(f"Данные Google Sheets загружены за {time.time() - started:.1f} сек.")
+
+# Выбор хранилища. Если локальные данные уже есть (база SQLite или снимок),
+# Google Sheets подключается в фоне и не задерживает старт
+journal_entries = journal.read() if journal else []
+replicas = ReplicaCoordinator(REPLICA_DB) if REPLICA_DB else None
+if STORAGE_BACKEND == "sqlite":
+    local_storage = SQLiteStorage(SQLITE_PATH)
+    background_sheets = not local_storage.is_empty()
+else:
+    local_storage = None
+    background_sheets = load_snapshot()
+sheets_storage = SheetsStorage() if SHEETS_ENABLED else None
+if replicas:
+    # Google Sheets пишет только лидер — из общей ленты изменений
+    storage = SharedStorage(local_storage, replicas)
+elif local_storage:
+    storage = ReplicatedStorage(local_storage, sheets_storage) if sheets_storage else local_storage
+else:
+    storage = sheets_storage
+print(f"Хранилище: {storage.name}")
 
-users = load_users()
-last_choice, last_agr = load_last_choice()
+if sheets_storage and not background_sheets:
+    start_sheets(journal_entries)
+if local_storage:
+    loaded_choice, loaded_agr = local_storage.load_cooldowns()
+    users.replace(members_from_records(local_storage.load_users()))
+    last_choice.replace(loaded_choice)
+    last_agr.replace(loaded_agr)
+    load_stats()
+if sheets_storage and background_sheets:
+    threading.Thread(target=start_sheets, args=(journal_entries,), daemon=True).start()
+if sheets_storage:
+    # Фоновый fsync журнала: изменения пишутся в журнал и во время загрузки
+    threading.Thread(target=journal.run, daemon=True).start()
+else:
+    sheets_loaded.set()
+if replicas:
+    threading.Thread(target=replicas.run, daemon=True).start()
+    atexit.register(replicas.release)
 
-# Фоновое переподключение к Google Sheets
-schedule.every(5).minutes.do(reconnect_sheets)
+if SHEETS_PRIMARY:
+    scheduler.every(SNAPSHOT_INTERVAL * 60, save_snapshot)
+    atexit.register(save_snapshot)
+atexit.register(storage.flush)
 
 # Фразы для roast (agr)
 roast_phrases = [
@@ -366,151 +2411,723 @@ coin_sides = [
     "Монета улетела и не вернулась, твоя попа распархнулась 🪙",
 ]
 
-# Функция для отправки случайного мема
-def send_daily_meme():
-    for chat_id in users.keys():
+# Общая HTTP-сессия: переиспользует соединения к внешним API
+http = requests.Session()
+http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MEME_WORKERS))
+
+# Token bucket: rate токенов в секунду, не больше capacity в запасе
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Забрать токен без ожидания
+    def try_acquire(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    # Забрать токен в долг: сколько секунд ждать, пока он станет доступен
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    # Забрать токен, дождавшись его при необходимости
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+telegram_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE)
+chat_limiters = OrderedDict()  # {chat_id: TokenBucket}, давно не использованные в начале
+chat_limiters_lock = threading.Lock()
+
+# Лимит чата. Корзины чатов, куда бот не писал TELEGRAM_CHAT_IDLE секунд,
+# давно полны: удалить такую — то же, что создать заново, поэтому словарь
+# не растёт с числом всех чатов, где бот когда-либо отвечал
+def chat_limiter(chat_id):
+    now = time.monotonic()
+    with chat_limiters_lock:
+        limiter = chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = chat_limiters[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        else:
+            chat_limiters.move_to_end(chat_id)
+        while chat_limiters:
+            oldest = next(iter(chat_limiters.values()))
+            if now - oldest.updated < TELEGRAM_CHAT_IDLE:
+                break
+            chat_limiters.popitem(last=False)
+        return limiter
+
+# Вызов Bot API с учётом лимитов Telegram и повтором после 429 (retry_after)
+def telegram_call(func, chat_id, *args, **kwargs):
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        telegram_limiter.acquire()
+        chat_limiter(str(chat_id)).acquire()
+        started = time.perf_counter()
+        try:
+            result = func(chat_id, *args, **kwargs)
+            observe_call("telegram", func.__name__, started)
+            return result
+        except telebot.apihelper.ApiTelegramException as e:
+            observe_call("telegram", func.__name__, started, ok=False)
+            if e.error_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            print(f"Telegram 429 для чата {chat_id}, повтор через {retry_after} сек.")
+            time.sleep(retry_after)
+
+# Очереди задач по чатам с пулом воркеров. У каждого чата своя очередь;
+# чат с ожидающими задачами стоит в общей очереди готовых не более одного
+# раза, поэтому чат обрабатывает только один воркер (строго по порядку),
+# а разные чаты — параллельно. Наследник обязан определить handle
+class ChatWorkQueue(ABC):
+    name = "queue"
+
+    def __init__(self, workers, limit, chat_limit):
+        self.workers = workers
+        self.limit = limit
+        self.chat_limit = chat_limit
+        self.lock = threading.Lock()
+        self.chats = {}             # {chat_id: deque(item)} — чаты в очереди или в работе
+        self.ready = queue.Queue()  # chat_id, готовые к обработке
+        self.depth = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True).start()
+
+    # Поставить задачу в очередь чата. False — очередь переполнена
+    def put(self, chat_id, item):
+        with self.lock:
+            chat_queue = self.chats.get(chat_id)
+            if self.depth >= self.limit or (chat_queue is not None and len(chat_queue) >= self.chat_limit):
+                self.rejected += 1
+                return False
+            if chat_queue is None:
+                chat_queue = self.chats[chat_id] = deque()
+                self.ready.put(chat_id)
+            chat_queue.append(item)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    # Задачи, которые воркер заберёт за раз (вызывается под блокировкой)
+    def take(self, chat_queue):
+        return [chat_queue.popleft()]
+
+    @abstractmethod
+    def handle(self, chat_id, items):
+        pass
+
+    def _worker(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                items = self.take(self.chats[chat_id])
+            try:
+                self.handle(chat_id, items)
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"Ошибка обработки в очереди {self.name}, чат {chat_id}: {e}")
+            with self.lock:
+                self.depth -= len(items)
+                if ok:
+                    self.processed += len(items)
+                else:
+                    self.failed += len(items)
+                if self.chats[chat_id]:
+                    self.ready.put(chat_id)
+                else:
+                    del self.chats[chat_id]
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "active_chats": len(self.chats),
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+# Очередь исходящих сообщений: обработчики не ждут HTTP, отправка идёт
+# через лимиты Telegram (общий и на чат) с повтором после 429. Подряд
+# идущие ответы одному чату можно склеить в одно сообщение
+class Outbox(ChatWorkQueue):
+    name = "outbox"
+
+    def __init__(self, workers=OUTBOX_WORKERS, limit=OUTBOX_QUEUE_LIMIT,
+                 chat_limit=OUTBOX_CHAT_QUEUE_LIMIT, coalesce=OUTBOX_COALESCE):
+        super().__init__(workers, limit, chat_limit)
+        self.coalesce = coalesce
+
+    def send(self, chat_id, text, reply_to_message_id=None):
+        return self.put(chat_id, (text, reply_to_message_id))
+
+    def take(self, chat_queue):
+        if not self.coalesce:
+            return [chat_queue.popleft()]
+        items = [chat_queue.popleft()]
+        length = len(items[0][0])
+        while chat_queue and length + 2 + len(chat_queue[0][0]) <= TELEGRAM_MESSAGE_LIMIT:
+            length += 2 + len(chat_queue[0][0])
+            items.append(chat_queue.popleft())
+        return items
+
+    def handle(self, chat_id, items):
+        if self.coalesce:
+            items = [("\n\n".join(text for text, _ in items), items[0][1])]
+        for text, reply_to_message_id in items:
+            deliver_message(chat_id, text, reply_to_message_id)
+
+def deliver_message(chat_id, text, reply_to_message_id=None):
+    reply_parameters = None
+    if reply_to_message_id:
+        reply_parameters = telebot.types.ReplyParameters(
+            reply_to_message_id, allow_sending_without_reply=True
+        )
+    return telegram_call(bot.send_message, chat_id, text, reply_parameters=reply_parameters)
+
+outbox = Outbox()
+if RUNTIME != "asyncio":
+    outbox.start()
+
+# Ответ на сообщение через очередь исходящих. Если очередь переполнена —
+# отправляем сразу, чтобы не потерять ответ
+def reply(message, text):
+    if not outbox.send(message.chat.id, text, message.message_id):
+        deliver_message(message.chat.id, text, message.message_id)
+
+def tenor_params(pos=None):
+    params = {"q": MEME_QUERY, "key": TENOR_API_KEY, "limit": MEME_PAGE_SIZE}
+    if pos:
+        params["pos"] = pos
+    return params
+
+# Ответ Tenor -> [(id, url), ...] и курсор следующей страницы
+def parse_tenor_page(data):
+    gifs = []
+    for result in data.get("results", []):
+        try:
+            gifs.append((result["id"], result["media_formats"]["gif"]["url"]))
+        except KeyError:
+            continue
+    return gifs, data.get("next") or None
+
+# Одна страница поиска Tenor: [(id, url), ...] и курсор следующей страницы
+def fetch_tenor_page(pos=None):
+    params = tenor_params(pos)
+    started = time.perf_counter()
+    try:
+        r = http.get(TENOR_SEARCH_URL, params=params, timeout=HTTP_TIMEOUT)
+    except Exception:
+        observe_call("tenor", "search", started, ok=False)
+        raise
+    observe_call("tenor", "search", started, ok=r.status_code == 200)
+    if r.status_code != 200:
+        raise RuntimeError(f"Ошибка Tenor API: {r.status_code}")
+    return parse_tenor_page(r.json())
+
+# Пул GIF в памяти: пополняется страницами Tenor в фоне, записи живут
+# MEME_POOL_TTL, при переполнении вытесняются самые старые. Для каждого
+# чата хранится короткая история, чтобы один GIF не приходил дважды подряд
+class MemePool:
+    def __init__(self, size=MEME_POOL_SIZE, ttl=MEME_POOL_TTL, history_size=MEME_HISTORY_SIZE):
+        self.size = size
+        self.ttl = ttl
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.gifs = OrderedDict()  # {gif_id: (url, expires_at)}, старые в начале
+        self.ids = []              # gif_id для случайного выбора за O(1)
+        self.history = {}          # {chat_id: (deque(gif_id), set(gif_id))}
+        self.next_pos = None       # курсор Tenor: каждое обновление берёт новые страницы
+
+    def refresh(self, pages=MEME_POOL_PAGES):
+        added = 0
+        pos = self.next_pos
+        for _ in range(pages):
+            gifs, pos = fetch_tenor_page(pos)
+            added += self.add(gifs)
+            if not pos:
+                break
+        return self.finish_refresh(pos, added)
+
+    # Добавить страницу GIF, вернуть число новых
+    def add(self, gifs):
+        added = 0
+        now = time.time()
+        with self.lock:
+            for gif_id, url in gifs:
+                if gif_id not in self.gifs:
+                    added += 1
+                self.gifs[gif_id] = (url, now + self.ttl)
+                self.gifs.move_to_end(gif_id)
+        return added
+
+    def finish_refresh(self, pos, added):
+        self.next_pos = pos
+        with self.lock:
+            self._evict()
+            total = len(self.gifs)
+        print(f"Пул мемов обновлён: +{added}, всего {total}")
+        return added
+
+    def _evict(self):
+        now = time.time()
+        while self.gifs:
+            gif_id, (url, expires_at) = next(iter(self.gifs.items()))
+            if expires_at > now and len(self.gifs) <= self.size:
+                break
+            del self.gifs[gif_id]
+        self.ids = list(self.gifs)
+
+    def __len__(self):
+        return len(self.gifs)
+
+    # GIF для чата без сетевых запросов: случайный, не из недавней истории
+    def pick(self, chat_id):
+        with self.lock:
+            if not self.ids:
+                return None
+            recent, seen = self.history.get(chat_id) or (None, ())
+            gif_id = random.choice(self.ids)
+            if gif_id in seen:
+                fresh = [candidate for candidate in self.ids if candidate not in seen]
+                if fresh:
+                    gif_id = random.choice(fresh)
+            if recent is None:
+                recent = deque()
+                seen = set()
+                self.history[chat_id] = (recent, seen)
+            if gif_id not in seen:
+                recent.append(gif_id)
+                seen.add(gif_id)
+                if len(recent) > self.history_size:
+                    seen.discard(recent.popleft())
+            return gif_id, self.gifs[gif_id][0]
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Ошибка обновления пула мемов: {e}")
+            time.sleep(MEME_POOL_REFRESH)
+
+meme_pool = MemePool()
+
+# LRU-кэш {gif_id Tenor: file_id Telegram}. Повторная отправка по file_id
+# не заставляет Telegram заново скачивать GIF. Кэш переживает перезапуск
+class MediaCache:
+    def __init__(self, path, size=MEDIA_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.saver = DelayedCall(MEDIA_CACHE_SAVE_DELAY, self.save)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                pairs = json.load(f)
+            with self.lock:
+                for gif_id, file_id in pairs[-self.size:]:
+                    self.items[gif_id] = file_id
+            print(f"Кэш file_id загружен: {len(self.items)} записей")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка загрузки кэша file_id: {e}")
+
+    def save(self):
+        with self.lock:
+            pairs = list(self.items.items())
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(pairs, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Ошибка сохранения кэша file_id: {e}")
+
+    def get(self, gif_id):
+        with self.lock:
+            file_id = self.items.get(gif_id)
+            if file_id:
+                self.items.move_to_end(gif_id)
+            return file_id
+
+    def put(self, gif_id, file_id):
+        with self.lock:
+            self.items[gif_id] = file_id
+            self.items.move_to_end(gif_id)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        self.saver.schedule()
+
+    def discard(self, gif_id):
+        with self.lock:
+            self.items.pop(gif_id, None)
+        self.saver.schedule()
+
+media_cache = MediaCache(MEDIA_CACHE_PATH)
+
+# Отправка GIF: по file_id, если он уже загружался, иначе по URL
+# с запоминанием file_id из ответа Telegram
+def send_meme(chat_id, gif_id, gif_url):
+    caption = "Ваш ежедневный мемчик 🤣"
+    file_id = media_cache.get(gif_id)
+    if file_id:
+        try:
+            return telegram_call(bot.send_animation, chat_id, file_id, caption=caption)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 400:
+                raise
+            print(f"file_id для {gif_id} недействителен, отправляю по URL")
+            media_cache.discard(gif_id)
+    message = telegram_call(bot.send_animation, chat_id, gif_url, caption=caption)
+    media = getattr(message, "animation", None) or getattr(message, "document", None)
+    if media and media.file_id:
+        media_cache.put(gif_id, media.file_id)
+    return message
+
+inactive_chats = set()  # Чаты, откуда бота удалили: им мемы не планируются
+async_runtime = None    # AsyncRuntime в режиме RUNTIME=asyncio
+
+# Мем в один чат в назначенное ему время (GIF берётся из пула)
+def send_chat_meme(chat_id):
+    if chat_id in inactive_chats:
+        return
+    if not len(meme_pool):
+        # Пул ещё не успел заполниться в фоне
         try:
-            url = f"https://tenor.googleapis.com/v2/search?q=funny&key={TENOR_API_KEY}&limit=20"
-            r = requests.get(url)
-            if r.status_code == 200:
-                data = r.json()
-                if "results" in data and len(data["results"]) > 0:
-                    gif_url = random.choice(data["results"])["media_formats"]["gif"]["url"]
-                    bot.send_animation(chat_id, gif_url, caption="Ваш ежедневный мемчик 🤣")
+            if async_runtime:
+                async_runtime.call(async_runtime.refresh_memes(pages=1))
             else:
-                print(f"Ошибка Tenor API: {r.status_code}")
+                meme_pool.refresh(pages=1)
         except Exception as e:
-            print(f"Ошибка отправки мема: {e}")
+            print(f"Ошибка обновления пула мемов: {e}")
+    picked = meme_pool.pick(chat_id)
+    if not picked:
+        print(f"Нет мемов для рассылки в чат {chat_id}")
+        metrics.inc("bot_memes_total", (("result", "failed"),))
+        return
+    try:
+        if async_runtime:
+            async_runtime.call(async_runtime.send_meme(chat_id, *picked))
+        else:
+            send_meme(chat_id, *picked)
+        metrics.inc("bot_memes_total", (("result", "sent"),))
+    except Exception as e:
+        metrics.inc("bot_memes_total", (("result", "failed"),))
+        print(f"Ошибка отправки мема в чат {chat_id}: {e}")
+        # Ошибки Bot API из TeleBot и AsyncTeleBot — разные классы с одинаковыми полями
+        if getattr(e, "error_code", None) == 403 or "chat not found" in str(getattr(e, "description", "")).lower():
+            deactivate_chat(chat_id)
+
+# Время мема чата на день: случайное в окне MEME_DAY_START–MEME_DAY_END, но
+# одно и то же для чата и дня, поэтому после перезапуска и на всех репликах
+# оно совпадает, а чаты получают мемы в разное время, без общего всплеска
+def meme_time(chat_id, day):
+    start = datetime.datetime.combine(day, MEME_DAY_START).timestamp()
+    end = datetime.datetime.combine(day, MEME_DAY_END).timestamp()
+    return start + random.Random(f"{day}:{chat_id}").random() * (end - start)
 
-# Случайное время для запуска мемов
-def schedule_random_times():
-    schedule.clear("daily_tasks")
-    meme_hour = random.randint(6, 23)
-    meme_minute = random.randint(0, 59)
-    schedule.every().day.at(f"{meme_hour:02d}:{meme_minute:02d}").do(send_daily_meme).tag("daily_tasks")
-    print(f"Запланировано: мемы в {meme_hour:02d}:{meme_minute:02d}")
+# Запланировать мем чату на сегодня, если его время ещё не прошло
+# и мем ещё не запланирован
+def schedule_chat_meme(chat_id):
+    run_at = meme_time(chat_id, datetime.date.today())
+    if run_at <= time.time() or chat_id in inactive_chats or scheduler.has(("meme", chat_id)):
+        return False
+    scheduler.at(run_at, leader_only(send_chat_meme), chat_id, key=("meme", chat_id))
+    return True
 
-# Обновляем расписание раз в сутки
-schedule_random_times()
-schedule.every().day.at("05:55").do(schedule_random_times)
+# Ежедневное планирование: каждому чату — своё время рассылки
+def plan_daily_memes():
+    planned = sum(schedule_chat_meme(chat_id) for chat_id in list(users.keys()))
+    print(f"Запланированы мемы: {planned} чатов до {MEME_DAY_END.strftime('%H:%M')}")
 
-def run_scheduler():
-    while True:
-        schedule.run_pending()
-        time.sleep(30)
+# Бота удалили из чата: снимаем его задачи до следующей команды оттуда
+def deactivate_chat(chat_id):
+    inactive_chats.add(chat_id)
+    cancelled = scheduler.cancel_chat(chat_id)
+    print(f"Чат {chat_id} неактивен, отменено задач: {cancelled}")
+
+def reactivate_chat(chat_id):
+    if chat_id in inactive_chats:
+        inactive_chats.discard(chat_id)
+        schedule_chat_meme(chat_id)
+        print(f"Чат {chat_id} снова активен")
+
+# Фоновое пополнение пула мемов (в асинхронном режиме — задачей цикла событий)
+if RUNTIME != "asyncio":
+    threading.Thread(target=meme_pool.run, daemon=True).start()
+atexit.register(media_cache.save)
+
+# Планируем мемы на сегодня и затем раз в сутки
+plan_daily_memes()
+scheduler.daily(MEME_PLAN_TIME, plan_daily_memes)
+
+threading.Thread(target=scheduler.run, daemon=True).start()
+
+# Политики ограничений. hit(state, now) -> (новое состояние, сколько ждать);
+# 0 — событие разрешено. ttl — через сколько секунд состояние можно забыть
+
+# Не больше limit событий за window секунд; окно начинается с первого события
+class FixedWindow:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.ttl = window
 
-threading.Thread(target=run_scheduler, daemon=True).start()
+    def hit(self, state, now):
+        start, count = state or (now, 0)
+        if now - start >= self.window:
+            start, count = now, 0
+        if count >= self.limit:
+            return (start, count), start + self.window - now
+        return (start, count + 1), 0
+
+# Token bucket: rate событий в секунду, всплеск до burst
+class TokenBucketPolicy:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = burst / rate
+
+    def hit(self, state, now):
+        tokens, updated = state or (self.burst, now)
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            return (tokens, now), (1 - tokens) / self.rate
+        return (tokens - 1, now), 0
+
+# Кд команды: одно использование в seconds. Время последнего использования
+# хранится в store (last_choice/last_agr) — оно сохраняется в хранилище и
+# не вытесняется из памяти
+class Cooldown:
+    def __init__(self, seconds, store, name):
+        self.seconds = seconds
+        self.store = store
+        self.name = name
+        self.ttl = seconds
+
+    def hit(self, state, now):
+        if state and now - state < self.seconds:
+            return state, state + self.seconds - now
+        return now, 0
+
+# Движок ограничений: состояние по ключу (чат, участник, команда) в
+# LRU-словаре ограниченного размера, устаревшие ключи вытесняются. Проверка O(1)
+class RateLimiter:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.states = OrderedDict()  # {key: (state, expires_at)}, давно не использованные в начале
+
+    # Учесть событие. Возвращает 0, если разрешено, иначе секунды до разрешения
+    def hit(self, key, policy, now=None):
+        now = time.time() if now is None else now
+        store = getattr(policy, "store", None)
+        if store is not None:
+            with store.lock(key):
+                if replicas:
+                    # Кд общий для всех реплик: проверка и запись в общей базе
+                    state, retry_after = replicas.hit_cooldown(policy, key, store.get(key), now)
+                else:
+                    state, retry_after = policy.hit(store.get(key), now)
+                if not retry_after:
+                    store[key] = state
+            return retry_after
+        with self.lock:
+            entry = self.states.pop(key, None)
+            state = entry[0] if entry and entry[1] > now else None
+            state, retry_after = policy.hit(state, now)
+            self.states[key] = (state, now + policy.ttl)
+            self._evict(now)
+        return retry_after
+
+    def _evict(self, now):
+        while self.states:
+            key, (state, expires_at) = next(iter(self.states.items()))
+            if expires_at > now and len(self.states) <= self.max_keys:
+                break
+            del self.states[key]
+
+    def __len__(self):
+        return len(self.states)
+
+rate_limiter = RateLimiter()
+flood_policy = TokenBucketPolicy(FLOOD_RATE, FLOOD_BURST)
+register_repeat_policy = FixedWindow(1, REGISTER_REPEAT_WINDOW)
+command_cooldowns = {
+    "/choose": Cooldown(CHOOSE_COOLDOWN, last_choice, "choose"),
+    "/agr": Cooldown(AGR_COOLDOWN, last_agr, "agr"),
+}
+
+# Оставшееся время в виде "X ч Y мин."
+def format_remaining(seconds):
+    remaining = int(seconds)
+    return f"{remaining // 3600} ч {(remaining % 3600) // 60} мин."
+
+# Период для /stats: None — за всё время, (начало, конец, подпись) — за
+# период, False — аргументы не разобраны
+def stats_period(args):
+    today = datetime.date.today()
+    if not args or args[0].lower() in ("all", "всё", "все"):
+        return None
+    name = args[0].lower()
+    if name in ("today", "день", "сегодня"):
+        return today, today, "сегодня"
+    if name in ("week", "неделя"):
+        return today - datetime.timedelta(days=6), today, "неделю"
+    if name in ("month", "месяц"):
+        return today - datetime.timedelta(days=29), today, "месяц"
+    try:
+        start = datetime.date.fromisoformat(args[0])
+        end = datetime.date.fromisoformat(args[1]) if len(args) > 1 else today
+    except ValueError:
+        return False
+    if start > end:
+        start, end = end, start
+    return start, end, f"{start.strftime('%d.%m.%Y')} — {end.strftime('%d.%m.%Y')}"
+
+# Команда, которую сейчас обрабатывает поток: по ней нагрузочный тест
+# относит вызовы внешних API к командам
+current_command = threading.local()
+
+# Длительность обработки команды — в гистограмму по команде
+def timed_command(func):
+    @functools.wraps(func)
+    def wrapper(message):
+        started = time.perf_counter()
+        command = message.text.split()[0].split("@")[0].lower()
+        current_command.name = command
+        try:
+            if profiler.active:
+                return profiler.run(command, func, message)
+            return func(message)
+        finally:
+            current_command.name = None
+            metrics.observe("bot_command_duration_seconds", time.perf_counter() - started, (("command", command),))
+    return wrapper
+
+# Бота удалили из чата или вернули в него
+@bot.my_chat_member_handler()
+def handle_membership(update):
+    chat_id = str(update.chat.id)
+    if update.new_chat_member.status in ("left", "kicked"):
+        deactivate_chat(chat_id)
+    else:
+        reactivate_chat(chat_id)
 
 # Обработчик команд
-@bot.message_handler(commands=["start", "test", "list", "choose", "stats", "register", "agr", "monetka", "createsheet", "checksheets"])
+@bot.message_handler(commands=["start", "test", "list", "choose", "stats", "register", "agr", "monetka", "createsheet", "checksheets", "profile"])
+@timed_command
 def handle_commands(message):
     chat_id = str(message.chat.id)
     command = message.text.split()[0].split("@")[0].lower()
 
+    # Флуд отбрасываем молча, до любых обращений к Telegram и хранилищу
+    if message.from_user and rate_limiter.hit((chat_id, message.from_user.id, "flood"), flood_policy):
+        print(f"Флуд от {message.from_user.id} в чате {chat_id}, команда {command} пропущена")
+        return
+    if chat_id in inactive_chats:
+        reactivate_chat(chat_id)
+
     if command in ["/start", "/test"]:
-        bot.reply_to(message, "Бот работает, хвала Аннубису! 😊")
+        reply(message, "Бот работает, хвала Аннубису! 😊")
 
     elif command == "/list":
         if chat_id not in users or not users[chat_id]:
-            bot.reply_to(message, "Нет зарегистрированных участников. Используйте /register, ебантяи!")
+            reply(message, "Нет зарегистрированных участников. Используйте /register, ебантяи!")
         else:
-            names = [u["name"] for u in users[chat_id]]
-            bot.reply_to(message, f"Участники: {', '.join(names)}")
+            names = [member.name for member in users[chat_id]]
+            reply(message, f"Участники: {', '.join(names)}")
 
     elif command == "/choose":
         if chat_id not in users or len(users[chat_id]) < 2:
-            bot.reply_to(message, f"Нужно минимум 2 участника! Сейчас: {len(users.get(chat_id, []))}")
+            reply(message, f"Нужно минимум 2 участника! Сейчас: {len(users.get(chat_id, []))}")
             return
 
-        current_time = time.time()
-        if chat_id in last_choice and current_time - last_choice[chat_id] < 86400:
-            remaining = int(86400 - (current_time - last_choice[chat_id]))
-            hours = remaining // 3600
-            minutes = (remaining % 3600) // 60
-            bot.reply_to(message, f"Ещё рано! Подождите {hours} ч {minutes} мин.")
+        remaining = rate_limiter.hit(chat_id, command_cooldowns["/choose"])
+        if remaining:
+            reply(message, f"Ещё рано! Подождите {format_remaining(remaining)}")
             return
 
-        participants = users[chat_id]
-        handsome = random.choice(participants)
-        not_handsome = random.choice(participants)
-        while not_handsome["id"] == handsome["id"]:
-            not_handsome = random.choice(participants)
+        handsome, not_handsome = users[chat_id].random_pair()
 
-        # Записываем в Google Таблицы или кэш
+        # Записываем в агрегаты и хранилище
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if sheets["stats"]:
-            try:
-                sheets["stats"].append_row(
-                    [current_date, str(handsome["id"]), "@" + handsome["name"], "Красавчик"]
-                )
-                sheets["stats"].append_row(
-                    [current_date, str(not_handsome["id"]), "@" + not_handsome["name"], "Пидор"]
-                )
-                print(f"Записано в Google Sheets: Красавчик @{handsome['name']}, Пидор @{not_handsome['name']}")
-            except Exception as e:
-                print(f"Ошибка записи в Google Sheets: {str(e)}")
-                stats_cache.append([current_date, str(handsome["id"]), "@" + handsome["name"], "Красавчик"])
-                stats_cache.append([current_date, str(not_handsome["id"]), "@" + not_handsome["name"], "Пидор"])
-                bot.reply_to(message, "Ошибка записи в Google Sheets, данные сохранены в локальном кэше")
-        else:
-            stats_cache.append([current_date, str(handsome["id"]), "@" + handsome["name"], "Красавчик"])
-            stats_cache.append([current_date, str(not_handsome["id"]), "@" + not_handsome["name"], "Пидор"])
-            print(f"Google Sheets недоступен, данные сохранены в локальном кэше: Красавчик @{handsome['name']}, Пидор @{not_handsome['name']}")
+        rows = [
+            make_stats_row(current_date, handsome, "Красавчик", chat_id),
+            make_stats_row(current_date, not_handsome, "Пидор", chat_id),
+        ]
+        for row in rows:
+            apply_stats_row(row)
+        storage.append_stats(rows)
+        print(f"Результат записан в хранилище: Красавчик @{handsome.name}, Пидор @{not_handsome.name}")
 
         # Фраза для выбора
         phrase = random.choice(epic_phrases).format(
-            handsome="@" + handsome["name"], not_handsome="@" + not_handsome["name"]
+            handsome="@" + handsome.name, not_handsome="@" + not_handsome.name
         )
 
         # Сообщение с фразой отдельно и потом сообщения для красавчика и пидора
-        bot.reply_to(message, phrase)
-        bot.reply_to(message, f"👑 Красавчик дня: @{handsome['name']}")
-        bot.reply_to(message, f"💥 Пидор дня: @{not_handsome['name']}")
+        reply(message, phrase)
+        reply(message, f"👑 Красавчик дня: @{handsome.name}")
+        reply(message, f"💥 Пидор дня: @{not_handsome.name}")
 
-        last_choice[chat_id] = current_time
-        save_last_choice()
+        storage.save_cooldown(chat_id, last_choice.get(chat_id), last_agr.get(chat_id))
 
     elif command == "/stats":
-        if not sheets["stats"]:
-            if not stats_cache:
-                bot.reply_to(message, "Статистика пуста. Используйте /choose!")
-                return
-            data = stats_cache
-            print("Google Sheets недоступен, использую локальный кэш для статистики")
-        else:
-            try:
-                data = sheets["stats"].get_all_values()[1:]
-                if not data and not stats_cache:
-                    bot.reply_to(message, "Статистика пуста. Используйте /choose!")
-                    return
-                data = data + stats_cache
-            except Exception as e:
-                print(f"Ошибка чтения Google Sheets: {str(e)}")
-                if not stats_cache:
-                    bot.reply_to(message, "Ошибка: не удалось подключиться к Google Таблицам и нет локального кэша.")
-                    return
-                data = stats_cache
-                print("Google Sheets недоступен, использую локальный кэш для статистики")
-
+        period = stats_period(message.text.split()[1:])
+        if period is False:
+            reply(message, "Использование: /stats [week | month | today | ГГГГ-ММ-ДД ГГГГ-ММ-ДД]")
+            return
         try:
-            stats = {}
-            for row in data:
-                try:
-                    user_id, username, status = row[1], row[2], row[3]
-                    if user_id not in stats:
-                        stats[user_id] = {"name": username, "wins": 0, "losses": 0}
-                    if status == "Красавчик":
-                        stats[user_id]["wins"] += 1
-                    elif status == "Пидор":
-                        stats[user_id]["losses"] += 1
-                except IndexError:
-                    print(f"Ошибка обработки строки статистики: {row}")
-                    continue
+            with stats_aggregates.lock(chat_id):
+                chat_stats = stats_aggregates.get(chat_id)
+                if not chat_stats:
+                    by_wins, by_losses = [], []
+                elif period:
+                    by_wins, by_losses = chat_stats.period(period[0], period[1])
+                else:
+                    # Копии записей, чтобы /choose мог обновлять агрегаты параллельно
+                    by_wins = [(user_id, dict(data)) for user_id, data in chat_stats.leaderboard("wins")]
+                    by_losses = [(user_id, dict(data)) for user_id, data in chat_stats.leaderboard("losses")]
+            if not by_wins:
+                if period:
+                    reply(message, f"За {period[2]} результатов нет. Используйте /choose!")
+                else:
+                    reply(message, "Статистика пуста. Используйте /choose!")
+                return
 
             # Полная статистика
-            response = "📊 Статистика:\n"
-            sorted_stats = sorted(stats.items(), key=lambda x: x[1]["wins"], reverse=True)
-            for _, data in sorted_stats:
+            response = f"📊 Статистика за {period[2]}:\n" if period else "📊 Статистика:\n"
+            for _, data in by_wins:
                 total = data["wins"] + data["losses"]
                 win_rate = (data["wins"] / total * 100) if total > 0 else 0
                 loss_rate = (data["losses"] / total * 100) if total > 0 else 0
@@ -542,57 +3159,48 @@ def handle_commands(message):
             }
 
             # Топ-3 Красавчиков
-            top_winners = sorted(stats.items(), key=lambda x: x[1]["wins"], reverse=True)[:3]
+            top_winners = by_wins[:3]
             response += "\n🏆 Топ-3 Красавчиков:\n"
             for i, (user_id, data) in enumerate(top_winners, 1):
                 comment = random.choice(top_comments.get(data["name"].lstrip("@"), ["просто легенда!"]))
                 response += f"{i}. {data['name']} - {data['wins']} раз, {comment}\n"
 
             # Топ-3 Пидоров
-            top_losers = sorted(stats.items(), key=lambda x: x[1]["losses"], reverse=True)[:3]
+            top_losers = by_losses[:3]
             response += "\n💥 Топ-3 Пидоров:\n"
             for i, (user_id, data) in enumerate(top_losers, 1):
                 comment = random.choice(loser_comments.get(data["name"].lstrip("@"), ["эпичный провал!"]))
                 response += f"{i}. {data['name']} - {data['losses']} раз, {comment}\n"
 
-            bot.reply_to(message, response)
+            reply(message, response)
         except Exception as e:
-            bot.reply_to(message, f"Ошибка при чтении статистики: {str(e)}")
+            reply(message, f"Ошибка при чтении статистики: {str(e)}")
             print(f"Ошибка формирования статистики: {e}")
 
     elif command == "/register":
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.first_name or f"User_{user_id}"
-        if chat_id not in users:
-            users[chat_id] = []
-        if user_id not in [u["id"] for u in users[chat_id]]:
-            users[chat_id].append({"id": user_id, "name": username})
-            save_users()
-            bot.reply_to(message, f"Вы зарегистрированы! @{username}")
+        if user_id not in users.get(chat_id, ()):
+            new_chat = chat_id not in users
+            storage.save_user(chat_id, user_id, username)
+            upsert_user(chat_id, user_id, username)
+            if new_chat:
+                schedule_chat_meme(chat_id)
+            reply(message, f"Вы зарегистрированы! @{username}")
             print(f"Пользователь @{username} зарегистрирован в чате {chat_id}")
         else:
-            if chat_id not in register_attempts:
-                register_attempts[chat_id] = {}
-            if user_id not in register_attempts[chat_id]:
-                register_attempts[chat_id][user_id] = 0
-            register_attempts[chat_id][user_id] += 1
-            if register_attempts[chat_id][user_id] == 1:
-                bot.reply_to(message, f"Вы уже зарегистрированы, долбаёб @{username}!")
+            if users[chat_id].get(user_id).name != username:
+                storage.save_user(chat_id, user_id, username)
+                upsert_user(chat_id, user_id, username)
+            if not rate_limiter.hit((chat_id, user_id, "/register"), register_repeat_policy):
+                reply(message, f"Вы уже зарегистрированы, долбаёб @{username}!")
             else:
-                bot.reply_to(message, f"Да иди ты уже нахуй, @{username}!")
-            print(f"Повторная попытка регистрации: @{username}, попытка #{register_attempts[chat_id][user_id]}")
+                reply(message, f"Да иди ты уже нахуй, @{username}!")
+            print(f"Повторная попытка регистрации: @{username}")
 
     elif command == "/agr":
         if chat_id not in users or not users[chat_id]:
-            bot.reply_to(message, "Нет зарегистрированных участников, сук! Используйте /register.")
-            return
-
-        current_time = time.time()
-        if chat_id in last_agr and current_time - last_agr[chat_id] < 86400:
-            remaining = int(86400 - (current_time - last_agr[chat_id]))
-            hours = remaining // 3600
-            minutes = (remaining % 3600) // 60
-            bot.reply_to(message, f"Ещё рано для агра! Подождите {hours} ч {minutes} мин., кд")
+            reply(message, "Нет зарегистрированных участников, сук! Используйте /register.")
             return
 
         author_id = message.from_user.id
@@ -601,73 +3209,574 @@ def handle_commands(message):
             or message.from_user.first_name
             or f"User_{author_id}"
         )
-        possible_targets = [u for u in users[chat_id] if u["id"] != author_id]
-        if not possible_targets:
-            bot.reply_to(message, "Нужно минимум 2 участника, чтобы запускать агр!")
+        target = users[chat_id].random(exclude=author_id)
+        if not target:
+            reply(message, "Нужно минимум 2 участника, чтобы запускать агр!")
+            return
+
+        remaining = rate_limiter.hit(chat_id, command_cooldowns["/agr"])
+        if remaining:
+            reply(message, f"Ещё рано для агра! Подождите {format_remaining(remaining)}, кд")
             return
-        target = random.choice(possible_targets)
-        target_name = target["name"]
+
+        target_name = target.name
         phrase = random.choice(roast_phrases).replace("{name}", f"@{target_name}")
         response = f"🔥 @{author} запускает агр!\n{phrase}"
-        bot.reply_to(message, response)
+        reply(message, response)
 
-        last_agr[chat_id] = current_time
-        save_last_choice()
+        storage.save_cooldown(chat_id, last_choice.get(chat_id), last_agr.get(chat_id))
 
     elif command == "/monetka":
         result = random.choice(coin_sides)
-        bot.reply_to(message, f"Монетка показала: {result}")
+        reply(message, f"Монетка показала: {result}")
 
     elif command == "/createsheet":
         try:
-            creds_dict = json.loads(GOOGLE_CREDENTIALS)
-            creds = Credentials.from_service_account_info(
-                creds_dict,
-                scopes=[
-                    "https://spreadsheets.google.com/feeds",
-                    "https://www.googleapis.com/auth/drive",
-                    "https://www.googleapis.com/auth/spreadsheets",
-                ],
-            )
-            new_spreadsheet_id = create_new_spreadsheet(creds)
+            new_spreadsheet_id = create_new_spreadsheet()
             if new_spreadsheet_id:
-                bot.reply_to(message, f"Создана новая таблица: {new_spreadsheet_id}. Обновите SPREADSHEET_ID в настройках!")
+                reply(message, f"Создана новая таблица: {new_spreadsheet_id}. Обновите SPREADSHEET_ID в настройках!")
                 print(f"Создана новая таблица: {new_spreadsheet_id}")
             else:
-                bot.reply_to(message, "Ошибка создания таблицы. Проверьте настройки Google API.")
+                reply(message, "Ошибка создания таблицы. Проверьте настройки Google API.")
         except Exception as e:
-            bot.reply_to(message, f"Ошибка создания таблицы: {str(e)}")
+            reply(message, f"Ошибка создания таблицы: {str(e)}")
             print(f"Ошибка создания таблицы: {str(e)}")
 
     elif command == "/checksheets":
         try:
-            creds_dict = json.loads(GOOGLE_CREDENTIALS)
-            creds = Credentials.from_service_account_info(
-                creds_dict,
-                scopes=[
-                    "https://spreadsheets.google.com/feeds",
-                    "https://www.googleapis.com/auth/drive",
-                    "https://www.googleapis.com/auth/spreadsheets",
-                ],
-            )
-            status = check_sheets_api(creds)
-            bot.reply_to(message, f"Статус Google Sheets: {status}")
+            status = check_sheets_api()
+            breaker = sheets_breaker.metrics()
+            reply(message, f"Статус Google Sheets: {status}\nПредохранитель: {breaker['state']}, "
+                           f"ошибок {breaker['failures']} из {breaker['calls']}, отклонено {breaker['rejected']}")
         except Exception as e:
-            bot.reply_to(message, f"Ошибка проверки Google Sheets: {str(e)}")
+            reply(message, f"Ошибка проверки Google Sheets: {str(e)}")
             print(f"Ошибка проверки Google Sheets: {str(e)}")
 
-# Маршрут для вебхуков
+    elif command == "/profile":
+        if not message.from_user or message.from_user.id not in ADMIN_IDS:
+            reply(message, "Команда только для администраторов")
+            return
+        # /profile [N] — следующие N команд; /profile 30s — окно в секундах; /profile stop
+        arg = message.text.split()[1].lower() if len(message.text.split()) > 1 else ""
+        if arg == "stop":
+            if profiler.active:
+                profiler.stop()
+                reply(message, "Профилирование остановлено, отчёт будет отправлен")
+            else:
+                reply(message, "Профилирование не запущено")
+            return
+        try:
+            if arg.endswith("s"):
+                updates, seconds = None, float(arg[:-1])
+            else:
+                updates, seconds = int(arg or PROFILE_DEFAULT_UPDATES), PROFILE_MAX_SECONDS
+            # С нулём, отрицательным числом или nan профилирование не закончилось бы
+            if (updates is not None and updates <= 0) or not seconds > 0:
+                raise ValueError(arg)
+        except ValueError:
+            reply(message, "Использование: /profile [N | 30s | stop]")
+            return
+        if not profiler.start(message.chat.id, updates, seconds):
+            reply(message, "Профилирование уже идёт")
+        elif updates:
+            reply(message, f"Профилирую следующие {updates} команд (не дольше {PROFILE_MAX_SECONDS} сек.)")
+        else:
+            reply(message, f"Профилирую {min(seconds, PROFILE_MAX_SECONDS):.0f} сек.")
+
+# Чат обновления: обновления одного чата обрабатываются строго по порядку
+def update_chat_id(update):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.chat.id
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query is not None and callback_query.message is not None:
+        return callback_query.message.chat.id
+    my_chat_member = getattr(update, "my_chat_member", None)
+    if my_chat_member is not None:
+        return my_chat_member.chat.id
+    return None
+
+# Отсев повторных доставок: Telegram повторяет обновление, если вебхук
+# ответил ошибкой или не успел. Последние update_id хранятся в LRU с
+# истечением (O(1), память ограничена), а максимальный принятый update_id
+# сохраняется на диск: после перезапуска всё, что не новее него, уже принято.
+# Метка действует UPDATE_DEDUP_TTL от последнего принятого обновления: дольше
+# Telegram не повторяет доставку, а после долгого простоя может начать
+# нумерацию заново с меньшего числа. Метка не поднимается выше обновлений, которые очередь отклонила: Telegram
+# пришлёт их снова. С REPLICA_DB отметки хранятся в общей базе — повтор,
+# пришедший на другую реплику, тоже отсеивается
+class UpdateDeduplicator:
+    def __init__(self, path=UPDATE_STATE_PATH, size=UPDATE_DEDUP_SIZE, ttl=UPDATE_DEDUP_TTL):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()  # {update_id: expires_at}, старые в начале
+        self.floor = 0               # update_id, принятые до перезапуска
+        self.floor_until = 0         # до этого времени метка floor действует
+        self.high_water = 0          # максимальный update_id, поставленный в очередь
+        self.high_water_at = 0       # когда он был принят
+        self.rejected = {}           # {update_id: expires_at}, отклонённые очередью
+        self.saver = DelayedCall(UPDATE_STATE_SAVE_DELAY, self.save)
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            high_water = int(data["high_water"])
+            # В файлах старого формата времени нет — берётся время записи файла
+            accepted_at = float(data.get("accepted_at") or os.path.getmtime(self.path))
+            if time.time() >= accepted_at + self.ttl:
+                print(f"Последний принятый update_id {high_water} старше {self.ttl} сек., не учитывается")
+                return
+            self.floor = self.high_water = high_water
+            self.floor_until = accepted_at + self.ttl
+            self.high_water_at = accepted_at
+            print(f"Последний принятый update_id: {self.floor}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка загрузки update_id: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            high_water = self.mark(time.time())
+            accepted_at = self.high_water_at
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"high_water": high_water, "accepted_at": accepted_at}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Ошибка сохранения update_id: {e}")
+
+    # Сохраняемая метка: всё не новее неё принято. Вызывается под self.lock
+    def mark(self, now):
+        for update_id, expires_at in list(self.rejected.items()):
+            if expires_at <= now:
+                del self.rejected[update_id]
+        if self.rejected:
+            return min(self.high_water, min(self.rejected) - 1)
+        return self.high_water
+
+    # Отметить обновление. True — это повтор, обрабатывать не нужно
+    def seen(self, update_id, now=None):
+        now = time.time() if now is None else now
+        if replicas:
+            return not replicas.claim_update(update_id, now, self.ttl)
+        with self.lock:
+            if update_id <= self.floor and now < self.floor_until:
+                return True
+            expires_at = self.recent.get(update_id)
+            if expires_at is not None and expires_at > now:
+                return True
+            self.recent[update_id] = now + self.ttl
+            self.recent.move_to_end(update_id)
+            while self.recent:
+                oldest, expires_at = next(iter(self.recent.items()))
+                if expires_at > now and len(self.recent) <= self.size:
+                    break
+                del self.recent[oldest]
+        return False
+
+    # Обновление поставлено в очередь: теперь его можно учесть в метке на диске
+    def accept(self, update_id, now=None):
+        if replicas:
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            was_rejected = self.rejected.pop(update_id, None) is not None
+            # Устаревшая метка заменяется даже меньшим update_id
+            advanced = update_id > self.high_water or now >= self.high_water_at + self.ttl
+            if advanced:
+                self.high_water = update_id
+                self.high_water_at = now
+        if advanced or was_rejected:
+            self.saver.schedule()
+
+    # Обновление не принято (очередь переполнена) — Telegram пришлёт его снова
+    def forget(self, update_id, now=None):
+        if replicas:
+            replicas.forget_update(update_id)
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            self.recent.pop(update_id, None)
+            self.rejected[update_id] = now + self.ttl
+
+# С репликами отметки живут в общей базе, файл не нужен
+update_dedup = UpdateDeduplicator("" if replicas else UPDATE_STATE_PATH)
+atexit.register(update_dedup.save)
+
+# Очередь входящих обновлений
+class UpdateDispatcher(ChatWorkQueue):
+    name = "updates"
+
+    def __init__(self, workers=UPDATE_WORKERS, limit=UPDATE_QUEUE_LIMIT, chat_limit=UPDATE_CHAT_QUEUE_LIMIT):
+        super().__init__(workers, limit, chat_limit)
+
+    # Поставить обновление в очередь. False — очередь переполнена.
+    # Повторная доставка уже принятого обновления молча отбрасывается
+    def submit(self, update):
+        if update_dedup.seen(update.update_id):
+            metrics.inc("bot_duplicate_updates_total")
+            return True
+        if not self.put(update_chat_id(update), update):
+            update_dedup.forget(update.update_id)
+            return False
+        update_dedup.accept(update.update_id)
+        return True
+
+    def handle(self, chat_id, updates):
+        bot.process_new_updates(updates)
+
+dispatcher = UpdateDispatcher()
+if RUNTIME != "asyncio":
+    dispatcher.start()
+
+# Маршрут для вебхуков: обновление ставится в очередь, ответ Telegram сразу
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def get_updates():
     try:
         json_string = request.get_data().decode("utf-8")
         update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if not dispatcher.submit(update):
+            # Telegram повторит доставку позже
+            print(f"Очередь обновлений переполнена, отклонено {update.update_id}")
+            return "Busy", 503
         return "OK", 200
     except Exception as e:
         print(f"Ошибка обработки вебхука: {e}")
         return "Error", 500
 
+# Состояние очереди обновлений
+@app.route("/backlog", methods=["GET"])
+def backlog():
+    queues = dispatcher.metrics()
+    queues["outbox"] = outbox.metrics()
+    if replicas:
+        queues["replica"] = replicas.metrics()
+    return queues, 200
+
+# Метрики для Prometheus: команды, внешние вызовы, задачи планировщика,
+# очереди и размеры кэшей
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    gauges = {}
+    counters = {}
+    for name, queue_metrics in (("updates", dispatcher.metrics()), ("outbox", outbox.metrics())):
+        labels = (("queue", name),)
+        gauges[("bot_queue_depth", labels)] = queue_metrics["depth"]
+        gauges[("bot_queue_max_depth", labels)] = queue_metrics["max_depth"]
+        gauges[("bot_queue_active_chats", labels)] = queue_metrics["active_chats"]
+        counters[("bot_queue_processed_total", labels)] = queue_metrics["processed"]
+        counters[("bot_queue_failed_total", labels)] = queue_metrics["failed"]
+        counters[("bot_queue_rejected_total", labels)] = queue_metrics["rejected"]
+    with stats_writer.lock:
+        gauges[("bot_pending_writes", (("kind", "stats"),))] = len(stats_cache)
+    with users_sync_lock:
+        gauges[("bot_pending_writes", (("kind", "users"),))] = len(users_dirty)
+    with last_choice_sync_lock:
+        gauges[("bot_pending_writes", (("kind", "cooldowns"),))] = len(last_choice_dirty)
+    gauges[("bot_cache_entries", (("cache", "users_chats"),))] = len(users)
+    gauges[("bot_cache_entries", (("cache", "stats_chats"),))] = len(stats_aggregates)
+    gauges[("bot_cache_entries", (("cache", "rate_limiter"),))] = len(rate_limiter)
+    gauges[("bot_cache_entries", (("cache", "media"),))] = len(media_cache.items)
+    gauges[("bot_cache_entries", (("cache", "meme_pool"),))] = len(meme_pool.ids)
+    gauges[("bot_cache_entries", (("cache", "chat_limiters"),))] = len(chat_limiters)
+    gauges[("bot_scheduled_jobs", ())] = len(scheduler)
+    if SHEETS_ENABLED:
+        breaker = sheets_breaker.metrics()
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            gauges[("bot_sheets_breaker_state", (("state", state),))] = int(breaker["state"] == state)
+        counters[("bot_sheets_breaker_rejected_total", ())] = breaker["rejected"]
+    if replicas:
+        gauges[("bot_replica_leader", (("replica", REPLICA_ID),))] = int(replicas.is_leader())
+    return metrics.render(gauges, counters), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Long polling через ту же очередь обновлений
+def run_polling():
+    offset = None
+    while True:
+        if replicas and not replicas.is_leader():
+            # getUpdates допускает одного получателя: опрашивает только лидер
+            offset = None
+            time.sleep(REPLICA_SYNC_INTERVAL)
+            continue
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT)
+            for update in updates:
+                # При переполнении ждём, а не теряем обновление
+                while not dispatcher.submit(update):
+                    time.sleep(0.5)
+                offset = update.update_id + 1
+        except Exception as e:
+            print(f"Ошибка polling: {e}")
+            time.sleep(3)
+
+# Вместо очереди готовых чатов ChatWorkQueue: чат с новыми задачами сразу
+# получает корутину в цикле событий. put можно вызывать из любого потока
+class LoopReady:
+    def __init__(self, spawn):
+        self.spawn = spawn
+        self.loop = None
+
+    def put(self, chat_id):
+        self.loop.call_soon_threadsafe(self.spawn, chat_id)
+
+# Очередь задач по чатам для цикла asyncio: тот же учёт, что у ChatWorkQueue,
+# но вместо пула потоков у каждого чата с задачами своя корутина, которая
+# выполняет их по порядку
+class AsyncChatQueue(ChatWorkQueue):
+    def __init__(self, limit, chat_limit):
+        super().__init__(0, limit, chat_limit)
+        self.loop = None
+        self.tasks = set()
+        self.ready = LoopReady(self._spawn)
+
+    def start(self, loop):
+        self.loop = self.ready.loop = loop
+
+    def _spawn(self, chat_id):
+        task = self.loop.create_task(self._run_chat(chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_chat(self, chat_id):
+        while True:
+            with self.lock:
+                items = self.take(self.chats[chat_id])
+            try:
+                await self.handle(chat_id, items)
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"Ошибка обработки в очереди {self.name}, чат {chat_id}: {e}")
+            with self.lock:
+                self.depth -= len(items)
+                if ok:
+                    self.processed += len(items)
+                else:
+                    self.failed += len(items)
+                if not self.chats[chat_id]:
+                    del self.chats[chat_id]
+                    return
+
+    @abstractmethod
+    async def handle(self, chat_id, items):
+        pass
+
+# Входящие обновления: те же обработчики (bot.process_new_updates) в
+# ограниченном пуле потоков, обновления одного чата — по порядку
+class AsyncUpdateQueue(AsyncChatQueue):
+    name = "updates"
+    submit = UpdateDispatcher.submit  # та же проверка повторов и переполнения
+
+    def __init__(self, executor, limit=ASYNC_UPDATE_LIMIT, chat_limit=UPDATE_CHAT_QUEUE_LIMIT):
+        super().__init__(limit, chat_limit)
+        self.executor = executor
+
+    async def handle(self, chat_id, updates):
+        await self.loop.run_in_executor(self.executor, bot.process_new_updates, updates)
+
+# Исходящие сообщения через AsyncTeleBot: ожидание ответа Telegram не
+# занимает поток, поэтому в полёте могут быть тысячи сообщений
+class AsyncOutbox(AsyncChatQueue):
+    name = "outbox"
+    send = Outbox.send
+    take = Outbox.take
+
+    def __init__(self, runtime, limit=OUTBOX_QUEUE_LIMIT, chat_limit=OUTBOX_CHAT_QUEUE_LIMIT, coalesce=OUTBOX_COALESCE):
+        super().__init__(limit, chat_limit)
+        self.runtime = runtime
+        self.coalesce = coalesce
+
+    async def handle(self, chat_id, items):
+        if self.coalesce:
+            items = [("\n\n".join(text for text, _ in items), items[0][1])]
+        for text, reply_to_message_id in items:
+            await self.runtime.deliver_message(chat_id, text, reply_to_message_id)
+
+# Асинхронный режим: один цикл событий держит обновления и ответы в работе
+# без потока на каждый сетевой вызов. Telegram — через AsyncTeleBot, Tenor
+# и вебхук — через aiohttp. Команды выполняет тот же handle_commands в
+# пуле из ASYNC_EXECUTOR_WORKERS потоков: там же идут запросы к SQLite и
+# Google Sheets. Планировщик задач остаётся в своих потоках, мемы он
+# отправляет через этот цикл
+class AsyncRuntime:
+    def __init__(self):
+        # Нужны только в этом режиме: pip install aiohttp
+        import aiohttp
+        from aiohttp import web
+        from telebot.async_telebot import AsyncTeleBot
+        from telebot.asyncio_helper import ApiTelegramException
+        self.aiohttp = aiohttp
+        self.web = web
+        self.api_error = ApiTelegramException
+        self.bot = AsyncTeleBot(BOT_TOKEN)
+        self.executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="async")
+        self.updates = AsyncUpdateQueue(self.executor)
+        self.outbox = AsyncOutbox(self)
+        self.loop = None
+        self.session = None
+
+    # Выполнить корутину в цикле из другого потока и дождаться результата
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # Вызов Bot API с теми же лимитами и повтором после 429, что telegram_call
+    async def telegram_call(self, func, chat_id, *args, **kwargs):
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            wait = max(telegram_limiter.reserve(), chat_limiter(str(chat_id)).reserve())
+            if wait:
+                await asyncio.sleep(wait)
+            started = time.perf_counter()
+            try:
+                result = await func(chat_id, *args, **kwargs)
+                observe_call("telegram", func.__name__, started)
+                return result
+            except self.api_error as e:
+                observe_call("telegram", func.__name__, started, ok=False)
+                if e.error_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                print(f"Telegram 429 для чата {chat_id}, повтор через {retry_after} сек.")
+                await asyncio.sleep(retry_after)
+
+    async def deliver_message(self, chat_id, text, reply_to_message_id=None):
+        reply_parameters = None
+        if reply_to_message_id:
+            reply_parameters = telebot.types.ReplyParameters(
+                reply_to_message_id, allow_sending_without_reply=True
+            )
+        return await self.telegram_call(self.bot.send_message, chat_id, text, reply_parameters=reply_parameters)
+
+    # То же, что send_meme: по file_id из кэша, иначе по URL
+    async def send_meme(self, chat_id, gif_id, gif_url):
+        caption = "Ваш ежедневный мемчик 🤣"
+        file_id = media_cache.get(gif_id)
+        if file_id:
+            try:
+                return await self.telegram_call(self.bot.send_animation, chat_id, file_id, caption=caption)
+            except self.api_error as e:
+                if e.error_code != 400:
+                    raise
+                print(f"file_id для {gif_id} недействителен, отправляю по URL")
+                media_cache.discard(gif_id)
+        message = await self.telegram_call(self.bot.send_animation, chat_id, gif_url, caption=caption)
+        media = getattr(message, "animation", None) or getattr(message, "document", None)
+        if media and media.file_id:
+            media_cache.put(gif_id, media.file_id)
+        return message
+
+    async def fetch_tenor_page(self, pos=None):
+        started = time.perf_counter()
+        try:
+            async with self.session.get(
+                TENOR_SEARCH_URL, params=tenor_params(pos), timeout=self.aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+            ) as r:
+                status = r.status
+                data = await r.json(content_type=None) if status == 200 else None
+        except Exception:
+            observe_call("tenor", "search", started, ok=False)
+            raise
+        observe_call("tenor", "search", started, ok=status == 200)
+        if status != 200:
+            raise RuntimeError(f"Ошибка Tenor API: {status}")
+        return parse_tenor_page(data)
+
+    async def refresh_memes(self, pages=MEME_POOL_PAGES):
+        added = 0
+        pos = meme_pool.next_pos
+        for _ in range(pages):
+            gifs, pos = await self.fetch_tenor_page(pos)
+            added += meme_pool.add(gifs)
+            if not pos:
+                break
+        return meme_pool.finish_refresh(pos, added)
+
+    async def run_meme_pool(self):
+        while True:
+            try:
+                await self.refresh_memes()
+            except Exception as e:
+                print(f"Ошибка обновления пула мемов: {e}")
+            await asyncio.sleep(MEME_POOL_REFRESH)
+
+    async def handle_webhook(self, request):
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+            if not self.updates.submit(update):
+                # Telegram повторит доставку позже
+                print(f"Очередь обновлений переполнена, отклонено {update.update_id}")
+                return self.web.Response(status=503, text="Busy")
+            return self.web.Response(text="OK")
+        except Exception as e:
+            print(f"Ошибка обработки вебхука: {e}")
+            return self.web.Response(status=500, text="Error")
+
+    async def handle_backlog(self, request):
+        queues, status = backlog()
+        return self.web.json_response(queues, status=status)
+
+    async def handle_metrics(self, request):
+        text, status, headers = metrics_endpoint()
+        return self.web.Response(text=text, status=status, headers=headers)
+
+    # Long polling: как run_polling, но ожидание ответа не держит поток
+    async def poll(self):
+        offset = None
+        while True:
+            if replicas and not replicas.is_leader():
+                offset = None
+                await asyncio.sleep(REPLICA_SYNC_INTERVAL)
+                continue
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT, request_timeout=POLLING_TIMEOUT + HTTP_TIMEOUT
+                )
+                for update in updates:
+                    while not self.updates.submit(update):
+                        await asyncio.sleep(0.5)
+                    offset = update.update_id + 1
+            except Exception as e:
+                print(f"Ошибка polling: {e}")
+                await asyncio.sleep(3)
+
+    async def main(self, webhook):
+        self.loop = asyncio.get_running_loop()
+        self.session = self.aiohttp.ClientSession()
+        self.updates.start(self.loop)
+        self.outbox.start(self.loop)
+        self.loop.create_task(self.run_meme_pool())
+        if not webhook:
+            await self.poll()
+            return
+        app = self.web.Application()
+        app.router.add_post(f"/{BOT_TOKEN}", self.handle_webhook)
+        app.router.add_get("/backlog", self.handle_backlog)
+        app.router.add_get("/metrics", self.handle_metrics)
+        runner = self.web.AppRunner(app)
+        await runner.setup()
+        await self.web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", 5000))).start()
+        print("Асинхронный вебхук-сервер запущен")
+        await asyncio.Event().wait()
+
+# Запуск в асинхронном режиме: очереди обновлений и ответов заменяются
+# асинхронными, остальной код бота (обработчики, хранилища, планировщик) тот же
+def run_async(webhook):
+    global async_runtime, dispatcher, outbox
+    async_runtime = AsyncRuntime()
+    dispatcher = async_runtime.updates
+    outbox = async_runtime.outbox
+    asyncio.run(async_runtime.main(webhook))
+
 # Установка вебхука
 def set_webhook():
     if not RAILWAY_PUBLIC_DOMAIN:
@@ -689,10 +3798,12 @@ def set_webhook():
 if __name__ == "__main__":
     print("Бот запускается...")
     webhook_success = set_webhook()
-    if webhook_success:
+    if RUNTIME == "asyncio":
+        run_async(webhook_success)
+    elif webhook_success:
         app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
     else:
         print("Вебхук не установлен, использую polling")
-        bot.infinity_polling()
+        run_polling()
 
 
@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py настраивается переменными окружения при импорте: SQLite в памяти,
+# без Google Sheets, файлы состояния во временном каталоге. Telegram и Tenor —
+# заглушки из bench.py, в сеть тесты не ходят
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bench
+
+WORKDIR = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update({
+    "TOKEN": "123456:TEST",
+    "TENOR_API_KEY": "test",
+    "TENOR_SEARCH_URL": bench.start_fake_tenor(0.0),
+    "STORAGE_BACKEND": "sqlite",
+    "SQLITE_PATH": ":memory:",
+    "GOOGLE_CREDENTIALS": "",
+    "SPREADSHEET_ID": "",
+    "REPLICA_DB": "",
+    "RUNTIME": "threads",
+    "RAILWAY_PUBLIC_DOMAIN": "",
+    "JOURNAL_PATH": os.path.join(WORKDIR, "journal.jsonl"),
+    "SNAPSHOT_PATH": os.path.join(WORKDIR, "snapshot.json"),
+    "MEDIA_CACHE_PATH": os.path.join(WORKDIR, "media_cache.json"),
+    "UPDATE_STATE_PATH": "",
+})
+
+import telebot.apihelper
+
+telegram = bench.FakeTelegram()
+telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram
+
+import bot as bot_module
+
+# Модуль бота с пустым состоянием в памяти
+@pytest.fixture
+def bot(monkeypatch):
+    bot_module.users.replace({})
+    bot_module.last_choice.replace({})
+    bot_module.last_agr.replace({})
+    bot_module.stats_aggregates.replace({})
+    bot_module.rate_limiter.states.clear()
+    bot_module.snapshot_stats_marks.clear()
+    with bot_module.stats_writer.lock:
+        bot_module.stats_cache.clear()
+    with bot_module.users_sync_lock:
+        bot_module.users_dirty.clear()
+    with bot_module.last_choice_sync_lock:
+        bot_module.last_choice_dirty.clear()
+    monkeypatch.setattr(bot_module, "recent_stats_rows", set())
+    monkeypatch.setattr(bot_module, "stats_loaded", False)
+    monkeypatch.setattr(bot_module, "snapshot_loaded", False)
+    return bot_module
@@ -0,0 +1,73 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+import bench
+
+pytest.importorskip("aiohttp")
+
+import telebot.asyncio_helper
+
+CHAT_ID = -700
+
+# Заглушка Telegram, запоминающая отправленные сообщения
+class RecordingTelegram(bench.FakeTelegram):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            reply_to = json.loads(params["reply_parameters"])["message_id"] if "reply_parameters" in params else None
+            self.messages.append((int(params["chat_id"]), reply_to, params["text"]))
+        return super().__call__(method, url, params, files, **kwargs)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_async_webhook_answers_commands(bot, monkeypatch):
+    telegram = RecordingTelegram()
+    monkeypatch.setattr(telebot.asyncio_helper, "API_URL", bench.start_fake_telegram(telegram))
+    port = free_port()
+    monkeypatch.setenv("PORT", str(port))
+    # run_async подменяет очереди модуля — после теста возвращаются потоковые
+    for name in ("dispatcher", "outbox", "async_runtime"):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+    threading.Thread(target=bot.run_async, args=(True,), daemon=True).start()
+
+    base = f"http://127.0.0.1:{port}"
+
+    def serving():
+        try:
+            return requests.get(f"{base}/metrics", timeout=1).status_code == 200
+        except requests.ConnectionError:
+            return False
+
+    assert wait_for(serving)
+    for update_id, user_id, text in ((7001, 1, "/register"), (7002, 2, "/register"), (7003, 1, "/choose")):
+        response = requests.post(f"{base}/{bot.BOT_TOKEN}", json=bench.make_update(update_id, CHAT_ID, user_id, text), timeout=5)
+        assert response.status_code == 200
+
+    assert wait_for(lambda: any(reply_to == 7003 for _, reply_to, _ in telegram.messages))
+    replies = {reply_to: text for chat_id, reply_to, text in telegram.messages if chat_id == CHAT_ID}
+    assert replies[7001] == "Вы зарегистрированы! @user1"
+    assert replies[7002] == "Вы зарегистрированы! @user2"
+    assert "@user1" in replies[7003] and "@user2" in replies[7003]
+
+    text = requests.get(f"{base}/metrics", timeout=5).text
+    assert 'bot_command_duration_seconds_count{command="/choose"}' in text
+    assert 'bot_queue_processed_total{queue="updates"} 3' in text
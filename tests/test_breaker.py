@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+def fail():
+    raise RuntimeError("503")
+
+def ok():
+    return "ok"
+
+@pytest.fixture
+def breaker(bot):
+    return bot.CircuitBreaker("test", window=4, min_calls=4, failure_rate=0.5, slow_call=5, open_time=0.05)
+
+# Половина запросов в окне — ошибки
+def trip(breaker):
+    for func in (ok, fail, ok, fail):
+        try:
+            breaker.call(func)
+        except RuntimeError:
+            pass
+
+def test_opens_at_failure_rate_and_rejects(bot, breaker):
+    trip(breaker)
+    assert breaker.state == bot.CircuitBreaker.OPEN
+    assert breaker.is_open()
+    with pytest.raises(bot.CircuitOpenError):
+        breaker.call(ok)
+    assert breaker.metrics()["rejected"] == 1
+
+def test_stays_closed_below_min_calls(bot, breaker):
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+    assert breaker.state == bot.CircuitBreaker.CLOSED
+
+def test_half_open_probe_closes_on_success(bot, breaker):
+    trip(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == bot.CircuitBreaker.HALF_OPEN
+    # Пока идёт пробный запрос, остальные отклоняются
+    assert not breaker.allow()
+    breaker.record(True, 0.01)
+    assert breaker.state == bot.CircuitBreaker.CLOSED
+    assert breaker.call(ok) == "ok"
+
+def test_half_open_probe_failure_reopens(bot, breaker):
+    trip(breaker)
+    time.sleep(0.06)
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    assert breaker.state == bot.CircuitBreaker.OPEN
+    assert breaker.is_open()
+
+def test_slow_calls_count_as_failures(bot):
+    breaker = bot.CircuitBreaker("test", window=2, min_calls=2, failure_rate=1, slow_call=0, open_time=60)
+    breaker.call(ok)
+    breaker.call(ok)
+    assert breaker.state == bot.CircuitBreaker.OPEN
+
+def test_request_errors_do_not_trip(bot):
+    breaker = bot.CircuitBreaker("test", window=2, min_calls=2, failure_rate=0.5, is_failure=lambda e: False)
+    for _ in range(4):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+    assert breaker.state == bot.CircuitBreaker.CLOSED
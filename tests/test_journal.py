@@ -0,0 +1,102 @@
+def choose_rows(chat_id, date, winner, loser):
+    return [
+        [date, str(winner), f"@user{winner}", "Красавчик", chat_id],
+        [date, str(loser), f"@user{loser}", "Пидор", chat_id],
+    ]
+
+def counts(bot, chat_id):
+    members = bot.stats_aggregates[chat_id].members
+    return {user_id: (member["wins"], member["losses"]) for user_id, member in members.items()}
+
+def test_journal_skips_torn_last_line(bot, tmp_path):
+    journal = bot.Journal(str(tmp_path / "journal.jsonl"))
+    entry = {"op": "user", "chat_id": "-5", "user_id": 1, "name": "user1"}
+    journal.write(entry)
+    # Процесс упал посреди записи
+    journal.file.write('{"op": "stats", "ro')
+    journal.file.flush()
+    assert journal.read() == [entry]
+    journal.truncate()
+    assert journal.read() == []
+
+def test_replay_without_snapshot_counts_each_row_once(bot, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", True)
+    written = choose_rows("-5", "2026-10-01 10:00:00", 1, 2)
+    pending = choose_rows("-5", "2026-10-02 10:00:00", 2, 1)
+    # Перед падением первая пара дошла до таблицы: агрегаты строятся по ней
+    monkeypatch.setattr(bot, "recent_stats_rows", {tuple(row) for row in written})
+    for row in written:
+        bot.apply_stats_row(row)
+
+    bot.replay_journal([
+        {"op": "stats", "rows": written},
+        {"op": "user", "chat_id": "-5", "user_id": 3, "name": "user3"},
+        {"op": "stats", "rows": pending},
+        {"op": "cooldown", "chat_id": "-5", "choose": 100.0, "agr": None},
+    ])
+
+    assert counts(bot, "-5") == {"1": (1, 1), "2": (1, 1)}
+    assert bot.stats_writer.pending() == pending
+    assert 3 in bot.users["-5"]
+    assert bot.users_dirty[("-5", 3)] == "user3"
+    assert bot.last_choice["-5"] == 100.0
+    assert "-5" in bot.last_choice_dirty
+
+def test_replay_into_replica_only_fills_queues(bot, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", False)
+    rows = choose_rows("-5", "2026-10-01 10:00:00", 1, 2)
+    bot.replay_journal([{"op": "stats", "rows": rows}])
+    assert "-5" not in bot.stats_aggregates
+    assert bot.stats_writer.pending() == rows
+
+# Перезапуск с Google Sheets, недоступным при старте: агрегаты берутся из
+# снимка, журнал проигрывается поверх него
+def restart_from_snapshot(bot, journal_entries, before_replay=()):
+    bot.stats_aggregates.replace({})
+    assert bot.load_snapshot()
+    for row in before_replay:
+        bot.apply_stats_row(row)
+    bot.replay_journal(journal_entries)
+
+def test_replay_after_snapshot_skips_rows_it_covers(bot, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", True)
+    monkeypatch.setattr(bot, "SNAPSHOT_PATH", str(tmp_path / "snapshot.json"))
+    monkeypatch.setattr(bot, "stats_loaded", True)
+    before = choose_rows("-5", "2026-10-01 10:00:00", 1, 2)
+    after = choose_rows("-5", "2026-10-02 10:00:00", 2, 1)
+    for row in before:
+        bot.apply_stats_row(row)
+    bot.save_snapshot()
+    # После снимка ещё один /choose успел попасть только в журнал
+    for row in after:
+        bot.apply_stats_row(row)
+    journal_entries = [{"op": "stats", "rows": before}, {"op": "stats", "rows": after}]
+
+    # Пока журнал не проигран, бот уже отвечает: новый /choose не должен
+    # заслонить строки журнала, которых нет в снимке
+    answered = choose_rows("-5", "2026-10-03 10:00:00", 1, 2)
+    restart_from_snapshot(bot, journal_entries, before_replay=answered)
+    assert counts(bot, "-5") == {"1": (2, 1), "2": (1, 2)}
+
+    # Снимок с правильными числами и повторный перезапуск с тем же журналом
+    # ничего не удваивают
+    bot.save_snapshot()
+    with bot.stats_writer.lock:
+        bot.stats_cache.clear()
+    restart_from_snapshot(bot, journal_entries + [{"op": "stats", "rows": answered}])
+    assert counts(bot, "-5") == {"1": (2, 1), "2": (1, 2)}
+
+def test_replay_after_stats_reload_ignores_snapshot_marks(bot, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", True)
+    monkeypatch.setattr(bot, "SNAPSHOT_PATH", str(tmp_path / "snapshot.json"))
+    monkeypatch.setattr(bot, "stats_loaded", True)
+    rows = choose_rows("-5", "2026-10-01 10:00:00", 1, 2)
+    for row in rows:
+        bot.apply_stats_row(row)
+    bot.save_snapshot()
+    assert bot.load_snapshot()
+    # Таблица доступна, но строка до неё так и не дошла: агрегаты строятся
+    # заново без неё, и журнал должен её вернуть
+    bot.load_stats()
+    bot.replay_journal([{"op": "stats", "rows": rows}])
+    assert counts(bot, "-5") == {"1": (1, 0), "2": (0, 1)}
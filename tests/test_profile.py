@@ -0,0 +1,17 @@
+import bench
+import telebot
+
+ADMIN = 42
+
+def profile(bot, arg):
+    update = bench.make_update(1, -5, ADMIN, f"/profile {arg}".strip())
+    bot.handle_commands(telebot.types.Message.de_json(update["message"]))
+
+def test_profile_rejects_non_positive_limits(bot, monkeypatch):
+    replies = []
+    monkeypatch.setattr(bot, "ADMIN_IDS", {ADMIN})
+    monkeypatch.setattr(bot, "reply", lambda message, text: replies.append(text))
+    for arg in ("0", "-3", "0s", "-5s", "nans"):
+        profile(bot, arg)
+        assert not bot.profiler.active
+    assert replies == ["Использование: /profile [N | 30s | stop]"] * 5
@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+def test_queue_without_handle_is_rejected(bot):
+    class NoHandler(bot.ChatWorkQueue):
+        pass
+
+    with pytest.raises(TypeError):
+        NoHandler(1, 10, 10)
+
+    class NoAsyncHandler(bot.AsyncChatQueue):
+        pass
+
+    with pytest.raises(TypeError):
+        NoAsyncHandler(10, 10)
+
+def test_chat_items_are_handled_in_order(bot):
+    handled = []
+    done = threading.Event()
+
+    class Recorder(bot.ChatWorkQueue):
+        def handle(self, chat_id, items):
+            handled.extend((chat_id, item) for item in items)
+            if len(handled) == 6:
+                done.set()
+
+    work = Recorder(3, 100, 10)
+    work.start()
+    for item in range(3):
+        for chat_id in ("-5", "-6"):
+            work.put(chat_id, item)
+    assert done.wait(2)
+    for chat_id in ("-5", "-6"):
+        assert [item for chat, item in handled if chat == chat_id] == [0, 1, 2]
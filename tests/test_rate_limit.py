@@ -0,0 +1,52 @@
+import time
+
+def test_fixed_window(bot):
+    limiter = bot.RateLimiter()
+    policy = bot.FixedWindow(2, 10)
+    assert limiter.hit("k", policy, now=100) == 0
+    assert limiter.hit("k", policy, now=101) == 0
+    assert limiter.hit("k", policy, now=102) == 8
+    assert limiter.hit("k", policy, now=110) == 0
+
+def test_token_bucket_refills(bot):
+    limiter = bot.RateLimiter()
+    policy = bot.TokenBucketPolicy(1, 2)
+    assert limiter.hit("k", policy, now=100) == 0
+    assert limiter.hit("k", policy, now=100) == 0
+    assert limiter.hit("k", policy, now=100) == 1
+    assert limiter.hit("k", policy, now=101) == 0
+
+def test_cooldown_lives_in_its_store(bot):
+    limiter = bot.RateLimiter()
+    cooldown = bot.Cooldown(60, bot.last_choice, "choose")
+    assert limiter.hit("-5", cooldown, now=1000) == 0
+    assert bot.last_choice["-5"] == 1000
+    assert limiter.hit("-5", cooldown, now=1030) == 30
+    assert limiter.hit("-5", cooldown, now=1060) == 0
+    assert len(limiter) == 0
+
+def test_lru_is_bounded(bot):
+    limiter = bot.RateLimiter(max_keys=3)
+    policy = bot.FixedWindow(1, 1000)
+    for key in range(5):
+        limiter.hit(key, policy, now=100)
+    assert len(limiter) == 3
+    # Вытеснены самые старые ключи — для них лимит начинается заново
+    assert limiter.hit(0, policy, now=101) == 0
+    assert limiter.hit(4, policy, now=101) > 0
+
+def test_telegram_token_bucket_reserve(bot):
+    bucket = bot.TokenBucket(10, 2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+
+def test_idle_chat_limiters_are_dropped(bot, monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_CHAT_IDLE", 0.05)
+    bot.chat_limiter("-5").acquire()
+    bot.chat_limiter("-6").acquire()
+    assert {"-5", "-6"} <= set(bot.chat_limiters)
+    time.sleep(0.06)
+    bot.chat_limiter("-7")
+    assert "-5" not in bot.chat_limiters and "-6" not in bot.chat_limiters
+    assert "-7" in bot.chat_limiters
@@ -0,0 +1,29 @@
+import gspread
+
+import bench
+
+def test_reconnect_keeps_rows_written_during_outage(bot, monkeypatch, tmp_path):
+    session = bench.FakeSheetsSession()
+    client = gspread.Client(bench.FakeCredentials(), session=session)
+    monkeypatch.setattr(bot.google_clients, "sheets_client", lambda: client)
+    monkeypatch.setattr(bot, "SHEETS_ENABLED", True)
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", True)
+    monkeypatch.setattr(bot, "storage", bot.SheetsStorage())
+    monkeypatch.setattr(bot, "journal", bot.Journal(str(tmp_path / "journal.jsonl")))
+    monkeypatch.setattr(bot, "sheets", {"stats": None, "users": None, "last_choice": None})
+    monkeypatch.setattr(bot, "sheets_prefetched", {})
+
+    # Таблица была недоступна при старте, /choose успел только в очередь
+    rows = [
+        ["2026-10-01 10:00:00", "1", "@user1", "Красавчик", "-5"],
+        ["2026-10-01 10:00:00", "2", "@user2", "Пидор", "-5"],
+    ]
+    for row in rows:
+        bot.apply_stats_row(row)
+    bot.storage.append_stats(rows)
+
+    bot.reconnect_sheets()
+    assert bot.sheets["stats"].get_all_values()[1:] == rows
+    assert bot.stats_loaded
+    members = bot.stats_aggregates["-5"].members
+    assert (members["1"]["wins"], members["2"]["losses"]) == (1, 1)
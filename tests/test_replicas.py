@@ -0,0 +1,37 @@
+import threading
+import time
+
+# Google Sheets для импорта: чтение листов занимает время
+class SlowSheets:
+    name = "sheets"
+
+    def load_users(self):
+        time.sleep(0.2)
+        return {"-5": [{"id": 1, "name": "user1"}, {"id": 2, "name": "user2"}]}
+
+    def load_cooldowns(self):
+        return {"-5": 1000.0}, {}
+
+    def load_stats_rows(self):
+        return [["2026-10-01 10:00:00", "1", "@user1", "Красавчик", "-5"]]
+
+def test_replicas_wait_for_sheets_import(bot, tmp_path):
+    path = str(tmp_path / "shared.db")
+    first, second = bot.ReplicaCoordinator(path, "first"), bot.ReplicaCoordinator(path, "second")
+    assert first.agree("sheets_import", "first") == "first"
+
+    def import_sheets():
+        bot.SQLiteStorage(path).import_from(SlowSheets())
+        first.agree("sheets_import_done", "first")
+
+    threading.Thread(target=import_sheets, daemon=True).start()
+    # Вторая реплика проиграла и читает общую базу только после импорта
+    assert second.agree("sheets_import", "second") == "first"
+    assert second.wait_agreement("sheets_import_done", 5, interval=0.02) == "first"
+    local = bot.SQLiteStorage(path)
+    assert [user["id"] for user in local.load_users()["-5"]] == [1, 2]
+    assert local.load_cooldowns()[0] == {"-5": 1000.0}
+
+def test_wait_for_sheets_import_gives_up(bot, tmp_path):
+    replica = bot.ReplicaCoordinator(str(tmp_path / "shared.db"), "second")
+    assert replica.wait_agreement("sheets_import_done", 0.1, interval=0.02) is None
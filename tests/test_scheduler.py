@@ -0,0 +1,59 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def scheduler(bot):
+    return bot.Scheduler(workers=2)
+
+def noop(*args):
+    pass
+
+def test_same_key_reschedules(scheduler):
+    now = time.time()
+    scheduler.at(now - 2, noop, "old", key=("meme", "-5"))
+    scheduler.at(now - 1, noop, "new", key=("meme", "-5"))
+    assert len(scheduler) == 1
+    job = scheduler._next_due()
+    assert job.args == ("new",)
+    assert not scheduler.has(("meme", "-5"))
+
+def test_cancel_chat_drops_only_its_jobs(scheduler):
+    now = time.time()
+    scheduler.at(now - 3, noop, "meme", key=("meme", "-5"))
+    scheduler.at(now - 2, noop, "reminder", key=("reminder", "-5"))
+    scheduler.at(now - 1, noop, "other", key=("meme", "-6"))
+    assert scheduler.cancel_chat("-5") == 2
+    assert scheduler.cancel_chat("-5") == 0
+    assert len(scheduler) == 1
+    assert scheduler._next_due().args == ("other",)
+
+def test_cancelled_entries_are_compacted(bot, scheduler, monkeypatch):
+    monkeypatch.setattr(bot, "SCHEDULER_COMPACT_MIN", 2)
+    now = time.time()
+    for chat_id in ("-1", "-2", "-3"):
+        scheduler.at(now + 60, noop, key=("meme", chat_id))
+    scheduler.cancel(("meme", "-1"))
+    assert len(scheduler.heap) == 3
+    scheduler.cancel(("meme", "-2"))
+    assert len(scheduler.heap) == 1
+    assert len(scheduler) == 1
+
+def test_next_daily_run_rolls_over_to_tomorrow(bot):
+    now = datetime.datetime(2026, 10, 18, 6, 0).timestamp()
+    assert bot.next_daily_run("05:55", now) == datetime.datetime(2026, 10, 19, 5, 55).timestamp()
+    assert bot.next_daily_run("06:30", now) == datetime.datetime(2026, 10, 18, 6, 30).timestamp()
+
+def test_run_executes_due_and_periodic_jobs(scheduler):
+    once = threading.Event()
+    ticks = []
+    scheduler.at(time.time() + 0.05, once.set, key=("meme", "-5"))
+    scheduler.every(0.05, lambda: ticks.append(1))
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    assert once.wait(2)
+    deadline = time.time() + 2
+    while len(ticks) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(ticks) >= 3
@@ -0,0 +1,70 @@
+import re
+
+import gspread
+import pytest
+
+import bench
+
+HEADER = ["Chat ID", "User ID", "Username"]
+
+# Лист в памяти с теми вызовами gspread, что делает компактизация
+class FakeWorksheet:
+    def __init__(self, rows, row_count=None):
+        self.rows = [list(row) for row in rows]
+        # Метаданные на момент открытия: после дописываний устаревают
+        self.row_count = row_count or len(self.rows)
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+    def update(self, values=None, range_name=None):
+        start = int(re.match(r"A(\d+)", range_name).group(1)) - 1
+        for i, row in enumerate(values):
+            self.rows[start + i] = list(row)
+
+    def batch_clear(self, ranges):
+        for a1 in ranges:
+            start, end = (int(number) for number in re.findall(r"\d+", a1))
+            for i in range(start - 1, min(end, len(self.rows))):
+                self.rows[i] = ["", "", ""]
+        while self.rows and not any(self.rows[-1]):
+            self.rows.pop()
+
+@pytest.fixture
+def users_sheet(bot, monkeypatch):
+    def install(rows, row_count=None):
+        sheet = FakeWorksheet([HEADER] + rows, row_count)
+        monkeypatch.setattr(bot, "sheets", {"stats": None, "users": sheet, "last_choice": None})
+        monkeypatch.setattr(bot, "users_rows", {})
+        return sheet
+    return install
+
+def test_replica_compaction_keeps_sheet_users(bot, users_sheet, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", False)
+    sheet = users_sheet([["-5", "1", "user1"], ["-5", "1", "user1"], ["-5", "2", "user2"]])
+    bot.load_users()
+    # Реплика не трогает память бота, но лист переписывается по его же содержимому
+    assert len(bot.users) == 0
+    assert sheet.rows == [HEADER, ["-5", "1", "user1"], ["-5", "2", "user2"]]
+    assert bot.users_rows == {("-5", 1): 2, ("-5", 2): 3}
+
+def test_compaction_clears_tail_past_stale_row_count(bot, users_sheet, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_PRIMARY", True)
+    rows = [["-5", "1", "user1"], ["-5", "1", "user1"], ["-5", "2", "user2"], ["-5", "2", "user2"], ["-5", "3", "user3"]]
+    sheet = users_sheet(rows, row_count=2)
+    bot.load_users()
+    assert sheet.rows == [HEADER, ["-5", "1", "user1"], ["-5", "2", "user2"], ["-5", "3", "user3"]]
+    assert [member.id for member in bot.users["-5"]] == [1, 2, 3]
+
+def test_init_sheets_reads_metadata_once(bot, monkeypatch):
+    session = bench.FakeSheetsSession()
+    requests = []
+    kind = session._kind
+    session._kind = lambda method, path: requests.append(kind(method, path)) or requests[-1]
+    client = gspread.Client(bench.FakeCredentials(), session=session)
+    monkeypatch.setattr(bot.google_clients, "sheets_client", lambda: client)
+    monkeypatch.setattr(bot, "sheets_prefetched", {})
+    sheets = bot.init_sheets()
+    assert [worksheet.title for worksheet in sheets.values()] == ["Sheet1", "Users", "LastChoice"]
+    assert requests.count("metadata") == 1
+    assert requests.count("batch_get") == 1
@@ -0,0 +1,42 @@
+import datetime
+
+def test_leaderboard_keeps_rankings_sorted(bot):
+    stats = bot.ChatStats()
+    for user_id, status in (("1", "Красавчик"), ("2", "Красавчик"), ("2", "Красавчик"), ("3", "Пидор")):
+        stats.add(user_id, f"@user{user_id}", status)
+    assert [user_id for user_id, _ in stats.leaderboard("wins")] == ["2", "1", "3"]
+    assert [user_id for user_id, _ in stats.leaderboard("losses")][0] == "3"
+
+def test_period_sums_daily_buckets(bot):
+    stats = bot.ChatStats()
+    rows = [
+        ("2026-10-01", "1", "Красавчик"), ("2026-10-01", "2", "Пидор"),
+        ("2026-10-02", "2", "Красавчик"), ("2026-10-02", "1", "Пидор"),
+        ("2026-10-03", "2", "Красавчик"), ("2026-10-03", "3", "Пидор"),
+        ("2026-10-10", "3", "Красавчик"), ("2026-10-10", "1", "Пидор"),
+    ]
+    for day, user_id, status in rows:
+        stats.add(user_id, f"@user{user_id}", status, day)
+
+    # Короткий период — перебор дней, длинный — перебор корзин
+    for start, end in ((datetime.date(2026, 10, 2), datetime.date(2026, 10, 3)),
+                       (datetime.date(2026, 9, 1), datetime.date(2026, 10, 3))):
+        by_wins, by_losses = stats.period(start, end)
+        totals = {user_id: (data["wins"], data["losses"]) for user_id, data in by_wins}
+        if start.month == 10:
+            assert totals == {"1": (0, 1), "2": (2, 0), "3": (0, 1)}
+        else:
+            assert totals == {"1": (1, 1), "2": (2, 1), "3": (0, 1)}
+        assert by_wins[0][0] == "2"
+
+    by_wins, _ = stats.period(datetime.date(2026, 10, 4), datetime.date(2026, 10, 9))
+    assert by_wins == []
+    # Итоги за всё время не меняются от запросов за период
+    assert stats.members["2"]["wins"] == 2
+
+def test_apply_stats_row_fills_day_bucket(bot):
+    bot.apply_stats_row(["2026-10-05 12:00:00", "1", "@user1", "Красавчик", "-5"])
+    bot.apply_stats_row(["2026-10-06 12:00:00", "1", "@user1", "Пидор", "-5"])
+    stats = bot.stats_aggregates["-5"]
+    assert stats.days == {"2026-10-05": {"1": [1, 0]}, "2026-10-06": {"1": [0, 1]}}
+    assert (stats.members["1"]["wins"], stats.members["1"]["losses"]) == (1, 1)
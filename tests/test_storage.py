@@ -0,0 +1,21 @@
+import pytest
+
+def test_storage_without_all_methods_is_rejected(bot):
+    class WriteOnly(bot.Storage):
+        def save_user(self, chat_id, user_id, username):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnly()
+
+def test_sqlite_round_trip(bot):
+    storage = bot.SQLiteStorage(":memory:")
+    assert storage.is_empty()
+    storage.save_user("-5", 1, "user1")
+    storage.save_user("-5", 1, "renamed")
+    storage.save_cooldown("-5", 100.0, None)
+    storage.append_stats([["2026-10-01 10:00:00", "1", "@renamed", "Красавчик", "-5"]])
+    assert storage.load_users() == {"-5": [{"id": 1, "name": "renamed"}]}
+    assert storage.load_cooldowns() == ({"-5": 100.0}, {})
+    assert storage.load_stats_rows() == [["2026-10-01 10:00:00", "1", "@renamed", "Красавчик", "-5"]]
+    assert not storage.is_empty()
@@ -0,0 +1,72 @@
+import json
+import time
+
+import bench
+import telebot
+
+def update(update_id, chat_id=-5):
+    return telebot.types.Update.de_json(json.dumps(bench.make_update(update_id, chat_id, 1, "/stats")))
+
+def test_rejected_update_is_accepted_after_restart(bot, monkeypatch, tmp_path):
+    path = str(tmp_path / "update_state.json")
+    monkeypatch.setattr(bot, "update_dedup", bot.UpdateDeduplicator(path))
+    # Очередь не запущена и вмещает одно обновление чата: второе отклоняется
+    dispatcher = bot.UpdateDispatcher(workers=1, limit=10, chat_limit=1)
+    assert dispatcher.submit(update(9))
+    assert not dispatcher.submit(update(10))
+    assert dispatcher.submit(update(11, chat_id=-6))
+    assert dispatcher.submit(update(9))  # повтор принятого отсеивается
+    bot.update_dedup.save()
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f)["high_water"] == 9
+
+    # После перезапуска Telegram повторяет отклонённое обновление
+    restarted = bot.UpdateDeduplicator(path)
+    assert restarted.seen(9)
+    assert not restarted.seen(10)
+    restarted.accept(10)
+    restarted.save()
+    assert bot.UpdateDeduplicator(path).floor == 10
+
+def test_replicas_share_seen_updates(bot, monkeypatch, tmp_path):
+    path = str(tmp_path / "replicas.db")
+    first, second = bot.ReplicaCoordinator(path, "first"), bot.ReplicaCoordinator(path, "second")
+    first_dedup, second_dedup = bot.UpdateDeduplicator(""), bot.UpdateDeduplicator("")
+    monkeypatch.setattr(bot, "replicas", first)
+    assert not first_dedup.seen(7, now=100)
+    # Повтор пришёл на другую реплику
+    monkeypatch.setattr(bot, "replicas", second)
+    assert second_dedup.seen(7, now=101)
+    # Вторая реплика не смогла поставить его в очередь — примет первая
+    assert not second_dedup.seen(8, now=101)
+    second_dedup.forget(8)
+    monkeypatch.setattr(bot, "replicas", first)
+    assert not first_dedup.seen(8, now=102)
+    assert first_dedup.seen(8, now=103)
+    # Отметка живёт UPDATE_DEDUP_TTL
+    assert not first_dedup.seen(7, now=100 + first_dedup.ttl + 1)
+
+def write_state(path, high_water, accepted_at):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"high_water": high_water, "accepted_at": accepted_at}, f)
+
+def test_stale_mark_does_not_drop_renumbered_updates(bot, tmp_path):
+    path = str(tmp_path / "update_state.json")
+    ttl = bot.UPDATE_DEDUP_TTL
+    # Неделю обновлений не было: Telegram начал нумерацию с меньшего числа
+    write_state(path, 900000, time.time() - 7 * 24 * 3600)
+    dedup = bot.UpdateDeduplicator(path)
+    assert not dedup.seen(12345)
+    dedup.accept(12345)
+    dedup.save()
+    assert bot.UpdateDeduplicator(path).floor == 12345
+
+    # Свежая метка действует, пока бот работает, но не дольше TTL
+    write_state(path, 900000, time.time())
+    dedup = bot.UpdateDeduplicator(path)
+    assert dedup.seen(12345)
+    later = time.time() + ttl + 1
+    assert not dedup.seen(12346, now=later)
+    dedup.accept(12346, now=later)
+    dedup.save()
+    assert bot.UpdateDeduplicator(path).floor == 12346